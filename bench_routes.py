@@ -0,0 +1,290 @@
+"""
+Route-matching benchmark.
+
+Generates synthetic routes.json catalogs (same schema as the real one),
+points the app at them and replays query mixes through
+get_matching_routes(), reporting latency percentiles and allocations.
+
+Usage:
+  python bench_routes.py                      # 1k, 10k, 100k routes
+  python bench_routes.py --sizes 1000 10000 --queries 300
+  python bench_routes.py --max-p95-ms 5       # exit 1 if any mix is slower
+  python bench_routes.py --json results.json  # keep numbers for comparison
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+# keep the compiled-catalog snapshot out of the real cache directory
+_BENCH_DIR = tempfile.mkdtemp(prefix="logenix_route_bench_")
+os.environ["APP_CACHE_DIR"] = os.path.join(_BENCH_DIR, "cache")
+
+import logenix_qoute_generator as app_module  # noqa: E402
+
+
+# -------------------------
+# SYNTHETIC CATALOG
+# -------------------------
+SYLLABLES = [
+    "ka", "ra", "chi", "pe", "sha", "war", "tor", "kham", "ja", "lal", "bad", "ta", "shk", "ent",
+    "al", "ma", "ty", "qa", "sim", "her", "at", "kan", "da", "har", "mer", "sin", "ning", "bo",
+    "qing", "dao", "tian", "jin", "du", "sham", "bu", "kha", "sa", "mar", "kand", "ter", "mez",
+]
+
+ROUTE_TYPES = [
+    "pol_to_pod",
+    "pol_to_city",
+    "city_to_city",
+    "city_to_pol_to_pod",
+    "pol_to_pod_to_city",
+    "city_to_pol_to_pod_to_city",
+]
+
+STATUSES = ["open"] * 6 + ["not sure"] * 2 + ["not used", "closed"]
+
+
+def _names(rng: random.Random, count: int, parts: int = 2) -> List[str]:
+    out: List[str] = []
+    seen = set()
+    while len(out) < count:
+        name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(parts, parts + 1))).title()
+        if name not in seen:
+            seen.add(name)
+            out.append(name)
+    return out
+
+
+def generate_catalog(size: int, seed: int = 7) -> Dict[str, Any]:
+    """
+    size routes shaped like routes.json: keywords, path, modes,
+    route_type, status, transit times, structured city/country boxes.
+    Vocabulary grows with the catalog so selectivity stays realistic.
+    """
+    rng = random.Random(seed)
+    scale = max(1, int(size ** 0.5))
+    countries = _names(rng, 12 + scale // 4, parts=3)
+    cities = _names(rng, 40 + 2 * scale)
+    ports = _names(rng, 20 + scale)
+    borders = _names(rng, 10 + scale // 2)
+    city_country = {c: rng.choice(countries) for c in cities}
+    port_country = {p: rng.choice(countries) for p in ports}
+
+    routes = []
+    for i in range(1, size + 1):
+        o_city, d_city = rng.sample(cities, 2)
+        pol, pod = rng.sample(ports, 2)
+        border = rng.choice(borders)
+        route_type = rng.choice(ROUTE_TYPES)
+        o_country = city_country[o_city]
+        d_country = city_country[d_city]
+
+        segments = []
+        if route_type.startswith("city"):
+            segments.append(o_city)
+        if "pol" in route_type:
+            segments.append(f"{pol} Port ({port_country[pol]})")
+        if "pod" in route_type:
+            segments.append(f"{pod} Port")
+        segments.append(f"{border} Border")
+        if route_type.endswith("city"):
+            segments.append(f"{d_city} ({d_country})")
+        tt_min = rng.randint(2, 15)
+
+        routes.append({
+            "id": f"S{i}",
+            "title": f"{segments[0]} to {segments[-1]}",
+            "pol_keywords": [pol.lower(), f"{pol.lower()} port"],
+            "pod_keywords": [pod.lower(), f"{pod.lower()} port"] if "pod" in route_type else [],
+            "origin_city_keywords": [o_city.lower()],
+            "destination_city_keywords": [d_city.lower()],
+            "path": " → ".join(segments) + ".",
+            "must_borders": [f"{border} Border"],
+            "transit_time_days": {"min": tt_min, "max": tt_min + rng.randint(2, 10)},
+            "route_status": rng.choice(STATUSES),
+            "route_type": route_type,
+            "modes": ["sea", "land"] if "pod" in route_type else ["land"],
+            "origin_country_keywords": [o_country.lower()],
+            "destination_country_keywords": [d_country.lower()],
+            "origin_city_country": {"cities": [o_city], "countries": [o_country]},
+            "destination_city_country": {"cities": [d_city], "countries": [d_country]},
+        })
+    return {"routes": routes}
+
+
+def generate_queries(catalog: Dict[str, Any], per_mix: int, seed: int = 11) -> Dict[str, List[Dict[str, Any]]]:
+    rng = random.Random(seed)
+    routes = catalog["routes"]
+
+    def sample(starts_with: str = "", ends_with: str = "") -> List[Dict[str, Any]]:
+        # each mix is drawn from routes that can actually answer it
+        pool = [
+            r for r in routes
+            if r["route_type"].startswith(starts_with) and r["route_type"].endswith(ends_with)
+        ] or routes
+        return [rng.choice(pool) for _ in range(per_mix)]
+
+    return {
+        "pol_only": [
+            {"pol": r["pol_keywords"][0], "pod": ""}
+            for r in sample(starts_with="pol")
+        ],
+        "origin_country_only": [
+            {"pol": "", "pod": "", "origin_country": r["origin_country_keywords"][0]}
+            for r in sample()
+        ],
+        "city_to_city": [
+            {
+                "pol": r["pol_keywords"][0],
+                "pod": (r["pod_keywords"] or [""])[0],
+                "origin_city": r["origin_city_keywords"][0],
+                "destination_city": r["destination_city_keywords"][0],
+            }
+            for r in sample(starts_with="city", ends_with="city")
+        ],
+        "with_borders": [
+            {
+                "pol": r["pol_keywords"][0],
+                "pod": (r["pod_keywords"] or [""])[0],
+                "origin_country": r["origin_country_keywords"][0],
+                "destination_country": r["destination_country_keywords"][0],
+                "transit_borders": [r["must_borders"][0], "", "", ""],
+            }
+            for r in sample()
+        ],
+    }
+
+
+# -------------------------
+# MEASUREMENT
+# -------------------------
+def _percentile(sorted_vals: List[float], pct: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(pct / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def _time_calls(fn: Callable[[Dict[str, Any]], Any], queries: List[Dict[str, Any]]) -> Tuple[List[float], int]:
+    timings: List[float] = []
+    matches = 0
+    for q in queries:
+        t0 = time.perf_counter()
+        routes, _best = fn(q)
+        timings.append((time.perf_counter() - t0) * 1000.0)
+        matches += len(routes)
+    return timings, matches
+
+
+def _alloc_per_call(fn: Callable[[Dict[str, Any]], Any], queries: List[Dict[str, Any]]) -> Tuple[float, float]:
+    """
+    Mean peak KiB per call and mean KiB still held by the returned result
+    (tracemalloc; separate pass because tracing skews timings).
+    """
+    peaks: List[int] = []
+    retained: List[int] = []
+    tracemalloc.start()
+    try:
+        for q in queries:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            result = fn(q)
+            after, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(after - before)
+            del result
+    finally:
+        tracemalloc.stop()
+    n = max(1, len(queries))
+    return sum(peaks) / n / 1024.0, sum(retained) / n / 1024.0
+
+
+def bench_size(size: int, per_mix: int, limit: int) -> Dict[str, Any]:
+    path = os.path.join(_BENCH_DIR, f"routes_{size}.json")
+    catalog_json = generate_catalog(size)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(catalog_json, f)
+
+    app_module.ROUTES_JSON_FILE = path
+    t0 = time.perf_counter()
+    app_module.get_route_catalog()
+    compile_s = time.perf_counter() - t0
+
+    def run(q: Dict[str, Any]):
+        return app_module.get_matching_routes(limit=limit or None, **q)
+
+    result: Dict[str, Any] = {"size": size, "catalog_load_s": round(compile_s, 3), "mixes": {}}
+    for mix, queries in generate_queries(catalog_json, per_mix).items():
+        run(queries[0])  # warm caches
+        timings, matches = _time_calls(run, queries)
+        timings.sort()
+        peak_kib, result_kib = _alloc_per_call(run, queries[: max(1, len(queries) // 4)])
+        result["mixes"][mix] = {
+            "queries": len(queries),
+            "avg_matches": round(matches / max(1, len(queries)), 1),
+            "p50_ms": round(_percentile(timings, 50), 3),
+            "p95_ms": round(_percentile(timings, 95), 3),
+            "p99_ms": round(_percentile(timings, 99), 3),
+            "max_ms": round(timings[-1], 3) if timings else 0.0,
+            "peak_kib": round(peak_kib, 1),
+            "result_kib": round(result_kib, 1),
+        }
+    return result
+
+
+def print_result(result: Dict[str, Any]):
+    print(f"\n{result['size']:,} routes  (catalog load {result['catalog_load_s']:.2f}s)")
+    print(f"  {'mix':<22}{'matches':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'peak KiB':>10}{'result KiB':>11}")
+    for mix, m in result["mixes"].items():
+        print(
+            f"  {mix:<22}{m['avg_matches']:>9}{m['p50_ms']:>9.3f}{m['p95_ms']:>9.3f}"
+            f"{m['p99_ms']:>9.3f}{m['max_ms']:>9.3f}{m['peak_kib']:>10.1f}{m['result_kib']:>11.1f}"
+        )
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark route matching on synthetic catalogs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=200, help="queries per mix")
+    parser.add_argument("--limit", type=int, default=0, help="top-k limit passed to get_matching_routes (0 = all)")
+    parser.add_argument("--max-p95-ms", type=float, default=0.0, help="fail if any mix has a slower p95")
+    parser.add_argument("--json", default="", help="also write results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    try:
+        for size in args.sizes:
+            result = bench_size(size, args.queries, args.limit)
+            print_result(result)
+            results.append(result)
+    finally:
+        shutil.rmtree(_BENCH_DIR, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.max_p95_ms > 0:
+        slow = [
+            (r["size"], mix, m["p95_ms"])
+            for r in results
+            for mix, m in r["mixes"].items()
+            if m["p95_ms"] > args.max_p95_ms
+        ]
+        for size, mix, p95 in slow:
+            print(f"[SLOW] {size:,} routes / {mix}: p95 {p95:.3f} ms > {args.max_p95_ms} ms")
+        if slow:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -2,15 +2,34 @@ from __future__ import annotations
 
 from flask import Flask, request, render_template
 import pandas as pd
+import numpy as np
 import os
 import re
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import io
+import hashlib
 import time
+import pickle
+import sqlite3
+import stat
+import tempfile
+import heapq
+import bisect
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from functools import lru_cache
 from datetime import datetime, date
 from typing import Optional, Tuple, List, Dict, Any
 
+try:
+    import fcntl  # POSIX only; gunicorn workers share locks through it
+except ImportError:  # pragma: no cover - Windows dev machines
+    fcntl = None
+
 app = Flask(__name__)
 
 # -------------------------
@@ -35,6 +54,55 @@ ONEDRIVE_QUERIES_PATH = os.getenv(
 ROUTES_HISTORY_FILE = "routes_history.xlsx"
 ROUTES_JSON_FILE = "routes.json"
 
+# Local scratch directory shared by all gunicorn workers on the same machine
+# (lock files, cached Graph token, ...).
+APP_CACHE_DIR = os.getenv(
+    "APP_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "logenix_quote_app")
+).strip()
+
+# Refresh the Graph token this many seconds before it actually expires.
+GRAPH_TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("GRAPH_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+
+# Keep-alive connection pool for login.microsoftonline.com + graph.microsoft.com
+GRAPH_POOL_CONNECTIONS = int(os.getenv("GRAPH_POOL_CONNECTIONS", "4"))
+GRAPH_POOL_MAXSIZE = int(os.getenv("GRAPH_POOL_MAXSIZE", "16"))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "10"))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", "120"))
+
+# How often the background refresher polls OneDrive for a new prices_updated.xlsx.
+# 0 disables the thread and revalidates on every quote instead.
+PRICES_REFRESH_INTERVAL_SECONDS = int(os.getenv("PRICES_REFRESH_INTERVAL_SECONDS", "300"))
+
+# Optional local SQLite journal of saved quotes; a scheduled exporter then
+# appends new rows to queries.xlsx on OneDrive. Only set it to a file on
+# persistent storage (not the temp dir / an ephemeral dyno disk). Unset,
+# every save is appended straight to queries.xlsx.
+QUOTES_JOURNAL_PATH = os.getenv("QUOTES_JOURNAL_PATH", "").strip()
+QUERIES_EXPORT_INTERVAL_SECONDS = int(os.getenv("QUERIES_EXPORT_INTERVAL_SECONDS", "60"))
+
+# Direct saves: how often to re-read and retry when queries.xlsx changed
+# between reading and uploading it (another save got in first).
+QUERIES_APPEND_ATTEMPTS = int(os.getenv("QUERIES_APPEND_ATTEMPTS", "3"))
+
+# Dropdown vocabularies (commodities, salespersons, ...) are served from memory
+# and re-read from queries.xlsx after this many seconds; values saved by this
+# worker are added right away.
+VOCABULARY_TTL_SECONDS = int(os.getenv("VOCABULARY_TTL_SECONDS", "300"))
+
+# /api/routes answers cached per normalized lane (+ routes.json version).
+ROUTES_API_CACHE_SIZE = int(os.getenv("ROUTES_API_CACHE_SIZE", "512"))
+ROUTES_API_CACHE_TTL_SECONDS = int(os.getenv("ROUTES_API_CACHE_TTL_SECONDS", "300"))
+ROUTES_BATCH_MAX_LANES = int(os.getenv("ROUTES_BATCH_MAX_LANES", "50"))
+
+# Composed itineraries: extra days charged per route change (transshipment),
+# and how many alternatives /api/routes/compose returns at most.
+ROUTE_COMPOSE_TRANSFER_DAYS = float(os.getenv("ROUTE_COMPOSE_TRANSFER_DAYS", "1"))
+ROUTE_COMPOSE_MAX_RESULTS = int(os.getenv("ROUTE_COMPOSE_MAX_RESULTS", "5"))
+
+# /api/locations/suggest: max suggestions per keystroke.
+LOCATION_SUGGEST_LIMIT = int(os.getenv("LOCATION_SUGGEST_LIMIT", "8"))
+
 SHOW_LIMIT = 1  # max 4 quote boxes
 
 
@@ -165,13 +233,177 @@ PACKAGING_TYPES = [
     "Overweight", "Out of Gauge (OOG)",
 ]
 
+# -------------------------
+# LOCAL CACHE / LOCK HELPERS
+# -------------------------
+def _cache_path(name: str) -> str:
+    os.makedirs(APP_CACHE_DIR, mode=0o700, exist_ok=True)
+
+    # makedirs leaves an existing directory's mode alone: close one we own
+    # (e.g. created by an older release with the default mode)
+    if hasattr(os, "getuid"):
+        st = os.lstat(APP_CACHE_DIR)
+        if st.st_uid == os.getuid() and stat.S_ISDIR(st.st_mode) and st.st_mode & 0o077:
+            os.chmod(APP_CACHE_DIR, 0o700)
+
+    return os.path.join(APP_CACHE_DIR, name)
+
+
+def _require_private_cache_dir():
+    """
+    Raises PermissionError unless APP_CACHE_DIR is a real directory owned
+    by this user and closed to group/other (e.g. someone else pre-created
+    it in a shared /tmp).
+    """
+    if not hasattr(os, "getuid"):
+        return
+    st = os.lstat(APP_CACHE_DIR)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{APP_CACHE_DIR} must be a directory owned by this user with mode 0700")
+
+
+def _open_private_cache_file(path: str):
+    """
+    Opens a file under APP_CACHE_DIR for binary reading, refusing it unless
+    the directory and the file belong to this user and are closed to
+    group/other. Pickles are only loaded through here: unpickling a
+    planted file would run arbitrary code as the app user.
+    """
+    _require_private_cache_dir()
+    f = open(path, "rb")
+    try:
+        if hasattr(os, "getuid"):
+            file_st = os.fstat(f.fileno())
+            if file_st.st_uid != os.getuid() or file_st.st_mode & 0o022:
+                raise PermissionError(f"{path} is not owned by this user or is writable by others")
+    except Exception:
+        f.close()
+        raise
+    return f
+
+
+@lru_cache(maxsize=1)
+def _code_fingerprint() -> str:
+    """Hash of this module's source, so caches of compiled objects die with a deploy."""
+    try:
+        with open(__file__, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()[:16]
+    except OSError:
+        return ""
+
+
+def _atomic_write_bytes(path: str, content: bytes):
+    """
+    Write to a temp file and rename over the target, so readers in other
+    workers see either the old file or the new one, never half of it.
+    Only into a private cache dir; the temp file gets a random name and is
+    created 0600 with O_EXCL | O_NOFOLLOW (mkstemp), so a planted file or
+    symlink is never written through.
+    """
+    _require_private_cache_dir()
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def _interprocess_lock(name: str, blocking: bool = True):
+    """
+    File lock shared by every worker process on this machine.
+    Yields True while the lock is held, or False when blocking=False
+    and another process already holds it.
+    Without fcntl (Windows dev runs) it always yields True.
+    """
+    if fcntl is None:
+        yield True
+        return
+
+    fd = os.open(_cache_path(f"{name}.lock"), os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+    with os.fdopen(fd, "r+") as fh:
+        flags = fcntl.LOCK_EX if blocking else (fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            fcntl.flock(fh.fileno(), flags)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+# -------------------------
+# GRAPH HTTP CLIENT
+# -------------------------
+_graph_session_lock = threading.Lock()
+_graph_session_state: Dict[str, Any] = {"pid": None, "session": None}
+
+
+def get_graph_session() -> requests.Session:
+    """
+    One pooled keep-alive session per worker process, so repeated Graph
+    calls reuse the TCP+TLS connection instead of handshaking every time.
+    Re-created after fork (gunicorn) so workers never share sockets.
+    """
+    pid = os.getpid()
+    with _graph_session_lock:
+        session = _graph_session_state["session"]
+        if session is None or _graph_session_state["pid"] != pid:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=GRAPH_POOL_CONNECTIONS,
+                pool_maxsize=GRAPH_POOL_MAXSIZE,
+                max_retries=0,
+            )
+            session.mount("https://", adapter)
+            session.headers.update({"Connection": "keep-alive"})
+            _graph_session_state["session"] = session
+            _graph_session_state["pid"] = pid
+    return session
+
+
+def graph_request(method: str, url: str, read_timeout: Optional[float] = None, **kwargs) -> requests.Response:
+    """
+    All Microsoft Graph / login traffic goes through here.
+    Uses (connect, read) timeouts so a dead host fails fast while large
+    workbook transfers still get the full read timeout.
+    """
+    kwargs.setdefault("timeout", (GRAPH_CONNECT_TIMEOUT, read_timeout or GRAPH_READ_TIMEOUT))
+    return get_graph_session().request(method, url, **kwargs)
+
+
 # -------------------------
 # ONEDRIVE GRAPH HELPERS
 # -------------------------
-def get_access_token() -> str:
-    if not TENANT_ID or not CLIENT_ID or not CLIENT_SECRET:
-        raise ValueError("TENANT_ID / CLIENT_ID / CLIENT_SECRET are missing.")
+GRAPH_TOKEN_CACHE_FILE = "graph_token.json"
+
+_token_lock = threading.Lock()          # guards _token_state
+_token_refresh_lock = threading.Lock()  # one OAuth round trip per process at a time
+_token_state: Dict[str, Any] = {
+    "access_token": "",
+    "expires_at": 0.0,
+    "refreshing": False,
+}
+
+
+def _token_is_fresh(expires_at: float, now: Optional[float] = None) -> bool:
+    now = time.time() if now is None else now
+    return (expires_at - GRAPH_TOKEN_REFRESH_MARGIN_SECONDS) > now
+
 
+def _request_new_access_token() -> Tuple[str, float]:
     url = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
 
     data = {
@@ -181,14 +413,151 @@ def get_access_token() -> str:
         "grant_type": "client_credentials",
     }
 
-    r = requests.post(url, data=data, timeout=60)
+    r = graph_request("POST", url, data=data, read_timeout=60)
     r.raise_for_status()
-    return r.json()["access_token"]
+    payload = r.json()
 
+    try:
+        expires_in = float(payload.get("expires_in") or 3599)
+    except (TypeError, ValueError):
+        expires_in = 3599.0
+    return payload["access_token"], time.time() + expires_in
 
-def _graph_drive_content_url(file_path: str) -> str:
+
+def _read_shared_token() -> Tuple[str, float]:
+    """
+    Token written by whichever worker refreshed last.
+    Ignored if it belongs to a different app registration.
+    """
+    try:
+        with _open_private_cache_file(_cache_path(GRAPH_TOKEN_CACHE_FILE)) as f:
+            data = json.load(f)
+        if data.get("tenant_id") != TENANT_ID or data.get("client_id") != CLIENT_ID:
+            return "", 0.0
+        return str(data.get("access_token") or ""), float(data.get("expires_at") or 0.0)
+    except Exception:
+        return "", 0.0
+
+
+def _write_shared_token(token: str, expires_at: float):
+    try:
+        _atomic_write_bytes(_cache_path(GRAPH_TOKEN_CACHE_FILE), json.dumps({
+            "tenant_id": TENANT_ID,
+            "client_id": CLIENT_ID,
+            "access_token": token,
+            "expires_at": expires_at,
+        }).encode("utf-8"))
+    except Exception as e:
+        print("Could not write shared Graph token cache:", e)
+
+
+def _refresh_access_token(stale_token: str = "") -> str:
+    """
+    Only one thread per worker and one worker per machine talk to
+    login.microsoftonline.com at a time. Everybody else waits on the
+    locks and then picks up the token the winner wrote.
+    stale_token: a token Graph rejected; it is never handed out again,
+    but a newer token written by another thread / worker is reused.
+    """
+    with _token_refresh_lock:
+        with _token_lock:
+            token = _token_state["access_token"]
+            expires_at = float(_token_state["expires_at"] or 0.0)
+        if stale_token and token and token != stale_token and _token_is_fresh(expires_at):
+            # another thread already replaced the rejected token
+            return token
+
+        with _interprocess_lock("graph_token"):
+            token, expires_at = _read_shared_token()
+            if not token or not _token_is_fresh(expires_at) or token == stale_token:
+                token, expires_at = _request_new_access_token()
+                _write_shared_token(token, expires_at)
+
+        with _token_lock:
+            _token_state["access_token"] = token
+            _token_state["expires_at"] = expires_at
+
+    return token
+
+
+def _background_token_refresh():
+    try:
+        _refresh_access_token()
+    except Exception as e:
+        print("Background Graph token refresh failed:", e)
+    finally:
+        with _token_lock:
+            _token_state["refreshing"] = False
+
+
+def get_access_token() -> str:
+    """
+    Returns a cached Graph token.
+    - fresh token            -> returned as-is
+    - close to expiry        -> returned as-is, refresh starts in the background
+    - missing / expired      -> blocking refresh
+    """
+    if not TENANT_ID or not CLIENT_ID or not CLIENT_SECRET:
+        raise ValueError("TENANT_ID / CLIENT_ID / CLIENT_SECRET are missing.")
+
+    now = time.time()
+
+    with _token_lock:
+        token = _token_state["access_token"]
+        expires_at = float(_token_state["expires_at"] or 0.0)
+
+        # still accepted by Graph for at least a few more seconds
+        usable = bool(token) and (expires_at - 30) > now
+        start_background = usable and not _token_is_fresh(expires_at, now) and not _token_state["refreshing"]
+        if start_background:
+            _token_state["refreshing"] = True
+
+    if usable:
+        if start_background:
+            threading.Thread(target=_background_token_refresh, daemon=True).start()
+        return token
+
+    return _refresh_access_token()
+
+
+def invalidate_access_token(rejected_token: str) -> str:
+    """
+    Replaces a token Graph rejected (401). During a burst of 401s only the
+    first caller does the OAuth round trip; the rest find the shared token
+    already differs from the one they were rejected with and reuse it.
+    """
+    with _token_lock:
+        if _token_state["access_token"] == rejected_token:
+            _token_state["access_token"] = ""
+            _token_state["expires_at"] = 0.0
+    return _refresh_access_token(stale_token=rejected_token)
+
+
+def _graph_drive_item_url(file_path: str) -> str:
     safe_path = file_path.lstrip("/")
-    return f"https://graph.microsoft.com/v1.0/users/{ONEDRIVE_USER_EMAIL}/drive/root:/{safe_path}:/content"
+    return f"https://graph.microsoft.com/v1.0/users/{ONEDRIVE_USER_EMAIL}/drive/root:/{safe_path}"
+
+
+def _graph_drive_content_url(file_path: str) -> str:
+    return f"{_graph_drive_item_url(file_path)}:/content"
+
+
+def get_onedrive_item_metadata(file_path: str) -> Dict[str, Any]:
+    """
+    Cheap metadata call (no file body). cTag changes whenever the
+    file content changes, eTag on any change (content or metadata).
+    """
+    token = get_access_token()
+    url = _graph_drive_item_url(file_path)
+    headers = {"Authorization": f"Bearer {token}"}
+    params = {"$select": "id,eTag,cTag,lastModifiedDateTime,size"}
+
+    r = graph_request("GET", url, headers=headers, params=params, read_timeout=30)
+    if r.status_code == 401:
+        headers["Authorization"] = f"Bearer {invalidate_access_token(token)}"
+        r = graph_request("GET", url, headers=headers, params=params, read_timeout=30)
+    r.raise_for_status()
+    return r.json()
 
 
 def download_excel_from_onedrive(file_path: str) -> bytes:
@@ -197,12 +566,26 @@ def download_excel_from_onedrive(file_path: str) -> bytes:
 
     headers = {"Authorization": f"Bearer {token}"}
 
-    r = requests.get(url, headers=headers, timeout=120)
+    r = graph_request("GET", url, headers=headers)
+    if r.status_code == 401:
+        # cached token was rejected (revoked / rotated secret) -> retry once with a new one
+        headers["Authorization"] = f"Bearer {invalidate_access_token(token)}"
+        r = graph_request("GET", url, headers=headers)
     r.raise_for_status()
     return r.content
 
 
-def upload_excel_to_onedrive(file_path: str, content: bytes, retries: int = 3, retry_delay: float = 1.5):
+def upload_excel_to_onedrive(
+    file_path: str,
+    content: bytes,
+    retries: int = 3,
+    retry_delay: float = 1.5,
+    extra_headers: Optional[Dict[str, str]] = None
+):
+    """
+    extra_headers: e.g. If-Match / If-None-Match, so the PUT fails (412)
+    instead of overwriting a file that changed since it was read.
+    """
     token = get_access_token()
     url = _graph_drive_content_url(file_path)
 
@@ -210,12 +593,17 @@ def upload_excel_to_onedrive(file_path: str, content: bytes, retries: int = 3, r
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     }
+    headers.update(extra_headers or {})
 
     last_err = None
 
     for attempt in range(retries):
         try:
-            r = requests.put(url, headers=headers, data=content, timeout=120)
+            r = graph_request("PUT", url, headers=headers, data=content)
+            if r.status_code == 401 and attempt < retries - 1:
+                token = invalidate_access_token(token)
+                headers["Authorization"] = f"Bearer {token}"
+                continue
             r.raise_for_status()
             return
         except requests.exceptions.HTTPError as e:
@@ -233,13 +621,6 @@ def upload_excel_to_onedrive(file_path: str, content: bytes, retries: int = 3, r
         raise last_err
 
 
-def read_queries_df_from_onedrive() -> pd.DataFrame:
-    try:
-        content = download_excel_from_onedrive(ONEDRIVE_QUERIES_PATH)
-        return pd.read_excel(io.BytesIO(content), sheet_name=0)
-    except Exception:
-        return pd.DataFrame()
-
 # -------------------------
 # UTILS
 # -------------------------
@@ -342,16 +723,28 @@ def parse_date_any(v):
     return dt.date()
 
 
+@lru_cache(maxsize=256)
+def _header_index(columns: Tuple[Any, ...]) -> Dict[str, Any]:
+    index: Dict[str, Any] = {}
+    for c in columns:
+        index.setdefault(canon(c), c)
+    return index
+
+
+def header_index(columns: Any) -> Dict[str, Any]:
+    """
+    canonical header -> actual column name (first one wins), built once per
+    header set and shared between frames with the same columns. Read-only.
+    """
+    return _header_index(tuple(columns))
+
+
 def find_col_case_insensitive(df: pd.DataFrame, target: str) -> Optional[str]:
     """
     Finds a column in df by case-insensitive comparison.
     Returns actual column name or None.
     """
-    t = canon(target)
-    for c in df.columns:
-        if canon(c) == t:
-            return c
-    return None
+    return header_index(df.columns).get(canon(target))
 
 
 def validity_status_and_text(v) -> Tuple[str, Optional[str], Optional[date]]:
@@ -552,24 +945,16 @@ def route_requires_confirmation(val: Any) -> bool:
 # -------------------------
 # ROUTES (load from routes.json)
 # -------------------------
-def load_routes_json() -> List[Dict[str, Any]]:
-    if not os.path.exists(ROUTES_JSON_FILE):
+def _routes_from_payload(data: Any) -> List[Dict[str, Any]]:
+    routes = data.get("routes") if isinstance(data, dict) else data
+    if not isinstance(routes, list):
         return []
-    try:
-        with open(ROUTES_JSON_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
 
-        routes = data.get("routes") if isinstance(data, dict) else data
-        if not isinstance(routes, list):
-            return []
-
-        out: List[Dict[str, Any]] = []
-        for r in routes:
-            if isinstance(r, dict) and r.get("id"):
-                out.append(r)
-        return out
-    except Exception:
-        return []
+    out: List[Dict[str, Any]] = []
+    for r in routes:
+        if isinstance(r, dict) and r.get("id"):
+            out.append(r)
+    return out
 
 
 def normalize_route_type(val: Any) -> str:
@@ -708,7 +1093,15 @@ def route_specificity_rank(route: Dict[str, Any]) -> int:
 
     return rank
 
+@lru_cache(maxsize=8192)
+def _norm_kw_text(val: str, is_port: bool) -> str:
+    return normalize_location_key(val) if is_port else canon(val)
+
+
 def _norm_kw_value(val: Any, is_port: bool = False) -> str:
+    # route matching normalizes the same user values once per candidate route
+    if isinstance(val, str):
+        return _norm_kw_text(val, is_port)
     if is_port:
         return normalize_location_key(val)
     return canon(val)
@@ -728,40 +1121,101 @@ def _value_matches_keywords(value: Any, keywords: List[str], is_port: bool = Fal
     return False
 
 
-def _path_segments(route: Dict[str, Any]) -> List[str]:
+ROUTE_KEYWORD_FIELDS: Dict[str, bool] = {  # keyword field -> compared as a port/location key
+    "pol_keywords": True,
+    "pod_keywords": True,
+    "origin_city_keywords": False,
+    "origin_country_keywords": False,
+    "destination_city_keywords": False,
+    "destination_country_keywords": False,
+    "borders": False,
+}
+
+
+def _route_border_keywords(route: Dict[str, Any]) -> List[str]:
+    if isinstance(route, RouteRecord):
+        route = route.raw
+    return (
+        route.get("must_borders")
+        or route.get("border_keywords")
+        or route.get("transit_border_keywords")
+        or []
+    )
+
+
+def _normalized_keyword_set(keywords: List[str], is_port: bool = False) -> frozenset:
+    return frozenset(k for k in (_norm_kw_value(kw, is_port=is_port) for kw in (keywords or [])) if k)
+
+
+def _route_keyword_set(route: Dict[str, Any], field: str) -> frozenset:
+    """
+    Normalized keywords of one ROUTE_KEYWORD_FIELDS field.
+    Compiled routes carry them precomputed.
+    """
+    if isinstance(route, RouteRecord):
+        return route.keyword_sets[field]
+    raw = _route_border_keywords(route) if field == "borders" else (route.get(field, []) or [])
+    return _normalized_keyword_set(raw, is_port=ROUTE_KEYWORD_FIELDS[field])
+
+
+def _route_has_keyword(route: Dict[str, Any], field: str, value: Any) -> bool:
+    v = _norm_kw_value(value, is_port=ROUTE_KEYWORD_FIELDS[field])
+    return bool(v) and v in _route_keyword_set(route, field)
+
+
+def _path_segments(route: Dict[str, Any]) -> Tuple[str, ...]:
+    if isinstance(route, RouteRecord):
+        return route.segments
     raw = str(route.get("path", "") or "").strip()
     if not raw:
-        return []
+        return ()
     parts = [p.strip() for p in raw.split("→")]
-    return [canon(p) for p in parts if canon(p)]
+    return tuple(canon(p) for p in parts if canon(p))
 
 
-def _segment_matches_keywords(segment: str, keywords: List[str], is_port: bool = False) -> bool:
-    if not segment:
-        return False
+@lru_cache(maxsize=8192)
+def _keyword_matcher(keys: Tuple[str, ...]) -> Optional[re.Pattern]:
+    """
+    One word-bounded alternation for already-normalized keywords:
+    a segment matches if any keyword appears in it as whole words.
+    """
+    keys = tuple(k for k in keys if k)
+    if not keys:
+        return None
+    alternation = "|".join(re.escape(k) for k in keys)
+    return re.compile(rf"(?<![a-z0-9])(?:{alternation})(?![a-z0-9])")
 
-    seg_cmp = normalize_location_key(segment) if is_port else canon(segment)
-    if not seg_cmp:
-        return False
 
-    for kw in (keywords or []):
-        kw_cmp = _norm_kw_value(kw, is_port=is_port)
-        if not kw_cmp:
-            continue
+def _keywords_matcher(keywords: List[str], is_port: bool = False) -> Optional[re.Pattern]:
+    keys = {_norm_kw_value(kw, is_port=is_port) for kw in (keywords or [])}
+    return _keyword_matcher(tuple(sorted(keys)))
 
-        if seg_cmp == kw_cmp:
-            return True
 
-        if re.search(rf"(?<![a-z0-9]){re.escape(kw_cmp)}(?![a-z0-9])", seg_cmp):
-            return True
+def _segment_key_matches(seg_cmp: str, matcher: Optional[re.Pattern]) -> bool:
+    return bool(seg_cmp) and matcher is not None and matcher.search(seg_cmp) is not None
 
-    return False
+
+def _segment_matches_keywords(segment: str, keywords: List[str], is_port: bool = False) -> bool:
+    if not segment:
+        return False
+    return _segment_key_matches(_norm_kw_value(segment, is_port=is_port), _keywords_matcher(keywords, is_port=is_port))
+
+
+def _route_segment_keys(route: Dict[str, Any], is_port: bool = False) -> Tuple[str, ...]:
+    """
+    Path segments normalized for comparison (precomputed on compiled routes).
+    """
+    if isinstance(route, RouteRecord):
+        return route.segment_port_keys if is_port else route.segments
+    segments = _path_segments(route)
+    return tuple(normalize_location_key(seg) for seg in segments) if is_port else segments
 
 
 def _any_segment_matches_text(segments: List[str], value: str, is_port: bool = False) -> bool:
     if not value:
         return False
-    return any(_segment_matches_keywords(seg, [value], is_port=is_port) for seg in segments)
+    matcher = _keywords_matcher([value], is_port=is_port)
+    return any(_segment_key_matches(_norm_kw_value(seg, is_port=is_port), matcher) for seg in segments)
 
 
 def _find_segment_index(
@@ -778,48 +1232,50 @@ def _find_segment_index(
     return None
 
 
-def _route_structured_cities(route: Dict[str, Any], side_key: str) -> List[str]:
+def _route_structured_values(route: Dict[str, Any], side_key: str, kind: str) -> Tuple[str, ...]:
+    if isinstance(route, RouteRecord):
+        return route.structured[(side_key, kind)]
     box = route.get(side_key) or {}
-    vals = box.get("cities") if isinstance(box, dict) else []
+    vals = box.get(kind) if isinstance(box, dict) else []
     if not isinstance(vals, list):
-        return []
-    return [str(x).strip() for x in vals if str(x).strip()]
+        return ()
+    return tuple(str(x).strip() for x in vals if str(x).strip())
 
 
-def _route_structured_countries(route: Dict[str, Any], side_key: str) -> List[str]:
-    box = route.get(side_key) or {}
-    vals = box.get("countries") if isinstance(box, dict) else []
-    if not isinstance(vals, list):
-        return []
-    return [str(x).strip() for x in vals if str(x).strip()]
+def _route_structured_keys(route: Dict[str, Any], side_key: str, kind: str) -> frozenset:
+    if isinstance(route, RouteRecord):
+        return route.structured_keys[(side_key, kind)]
+    return frozenset(canon(x) for x in _route_structured_values(route, side_key, kind))
+
+
+def _route_structured_cities(route: Dict[str, Any], side_key: str) -> Tuple[str, ...]:
+    return _route_structured_values(route, side_key, "cities")
+
+
+def _route_structured_countries(route: Dict[str, Any], side_key: str) -> Tuple[str, ...]:
+    return _route_structured_values(route, side_key, "countries")
 
 
 def _route_matches_origin_country_strict(route: Dict[str, Any], origin_country: str) -> bool:
-    c = canon(origin_country)
+    c = _norm_kw_value(origin_country)
     if not c:
         return False
 
-    structured = _route_structured_countries(route, "origin_city_country")
-    if structured:
-        return any(canon(x) == c for x in structured)
+    if _route_structured_countries(route, "origin_city_country"):
+        return c in _route_structured_keys(route, "origin_city_country", "countries")
 
-    return _value_matches_keywords(
-        origin_country,
-        route.get("origin_country_keywords", []) or [],
-        is_port=False
-    )
+    return _route_has_keyword(route, "origin_country_keywords", origin_country)
 
 
 def _route_matches_origin_city_strict(route: Dict[str, Any], origin_city: str) -> bool:
-    c = canon(origin_city)
+    c = _norm_kw_value(origin_city)
     if not c:
         return False
 
-    if _value_matches_keywords(origin_city, route.get("origin_city_keywords", []) or [], is_port=False):
+    if _route_has_keyword(route, "origin_city_keywords", origin_city):
         return True
 
-    structured = _route_structured_cities(route, "origin_city_country")
-    if structured and any(canon(x) == c for x in structured):
+    if c in _route_structured_keys(route, "origin_city_country", "cities"):
         return True
 
     segments = _path_segments(route)
@@ -830,96 +1286,100 @@ def _route_matches_origin_city_strict(route: Dict[str, Any], origin_city: str) -
 
 
 def _route_matches_pol_strict(route: Dict[str, Any], pol: str) -> bool:
-    if not normalize_location_key(pol):
+    if not _norm_kw_value(pol, is_port=True):
         return False
-    return _value_matches_keywords(pol, route.get("pol_keywords", []) or [], is_port=True)
+    return _route_has_keyword(route, "pol_keywords", pol)
 
 
 def _route_matches_pod_strict(route: Dict[str, Any], pod: str) -> bool:
-    if not normalize_location_key(pod):
+    if not _norm_kw_value(pod, is_port=True):
         return False
-    return _value_matches_keywords(pod, route.get("pod_keywords", []) or [], is_port=True)
+    return _route_has_keyword(route, "pod_keywords", pod)
 
 
 def _route_matches_destination_city_strict(route: Dict[str, Any], destination_city: str) -> bool:
-    c = canon(destination_city)
+    c = _norm_kw_value(destination_city)
     if not c:
         return False
 
-    if _value_matches_keywords(destination_city, route.get("destination_city_keywords", []) or [], is_port=False):
+    if _route_has_keyword(route, "destination_city_keywords", destination_city):
         return True
 
-    structured = _route_structured_cities(route, "destination_city_country")
-    if structured and any(canon(x) == c for x in structured):
+    if c in _route_structured_keys(route, "destination_city_country", "cities"):
         return True
 
     return False
 
 
 def _route_matches_destination_country_strict(route: Dict[str, Any], destination_country: str) -> bool:
-    c = canon(destination_country)
+    c = _norm_kw_value(destination_country)
     if not c:
         return False
 
-    structured = _route_structured_countries(route, "destination_city_country")
-    if structured:
-        return any(canon(x) == c for x in structured)
+    if _route_structured_countries(route, "destination_city_country"):
+        return c in _route_structured_keys(route, "destination_city_country", "countries")
 
-    return _value_matches_keywords(
-        destination_country,
-        route.get("destination_country_keywords", []) or [],
-        is_port=False
-    )
+    return _route_has_keyword(route, "destination_country_keywords", destination_country)
 
 
-def _first_segment_matches_origin_city(route: Dict[str, Any], origin_city: str) -> bool:
+def _route_pol_matcher(route: Dict[str, Any]) -> Optional[re.Pattern]:
+    if isinstance(route, RouteRecord):
+        return route.pol_matcher
+    return _keyword_matcher(tuple(sorted(_route_keyword_set(route, "pol_keywords"))))
+
+
+def _route_ends_at_destination_city(route: Dict[str, Any]) -> bool:
+    """
+    True if the last path segment names one of the route's structured
+    destination cities (the end city stands in for the POD/POL).
+    """
+    if isinstance(route, RouteRecord):
+        return route.ends_at_destination_city
     segments = _path_segments(route)
-    if not segments:
+    structured = _route_structured_cities(route, "destination_city_country")
+    return bool(segments and structured and _segment_matches_keywords(segments[-1], structured, is_port=False))
+
+
+def _first_segment_matches_origin_city(route: Dict[str, Any], origin_city: str) -> bool:
+    keys = _route_segment_keys(route, is_port=False)
+    if not keys:
         return False
-    return _segment_matches_keywords(segments[0], [origin_city], is_port=False)
+    return _segment_key_matches(keys[0], _keywords_matcher([origin_city], is_port=False))
 
 
 def _first_segment_matches_pol(route: Dict[str, Any], pol: str) -> bool:
-    segments = _path_segments(route)
-    if not segments:
+    keys = _route_segment_keys(route, is_port=True)
+    if not keys:
         return False
-    first_seg = segments[0]
+    first_seg = keys[0]
     return (
-        _segment_matches_keywords(first_seg, [pol], is_port=True)
-        or _segment_matches_keywords(first_seg, route.get("pol_keywords", []) or [], is_port=True)
+        _segment_key_matches(first_seg, _keywords_matcher([pol], is_port=True))
+        or _segment_key_matches(first_seg, _route_pol_matcher(route))
     )
 
 
 def _last_segment_matches_location_text(route: Dict[str, Any], value: str, is_port: bool = False) -> bool:
-    segments = _path_segments(route)
-    if not segments:
+    keys = _route_segment_keys(route, is_port=is_port)
+    if not keys:
         return False
 
-    last_seg = segments[-1]
-    if _segment_matches_keywords(last_seg, [value], is_port=is_port):
+    if _segment_key_matches(keys[-1], _keywords_matcher([value], is_port=is_port)):
         return True
 
     # If end is a city that represents the POD/POL location
-    structured_dest_cities = _route_structured_cities(route, "destination_city_country")
-    if structured_dest_cities and _segment_matches_keywords(last_seg, structured_dest_cities, is_port=False):
-        return True
-
-    return False
+    return _route_ends_at_destination_city(route)
 
 
 def _last_segment_matches_destination_city(route: Dict[str, Any], destination_city: str) -> bool:
-    segments = _path_segments(route)
-    if not segments:
+    keys = _route_segment_keys(route, is_port=False)
+    if not keys:
         return False
 
-    last_seg = segments[-1]
-
-    if _segment_matches_keywords(last_seg, [destination_city], is_port=False):
+    if _segment_key_matches(keys[-1], _keywords_matcher([destination_city], is_port=False)):
         return True
 
-    structured = _route_structured_cities(route, "destination_city_country")
-    if structured and _segment_matches_keywords(last_seg, structured, is_port=False):
-        return any(canon(x) == canon(destination_city) for x in structured)
+    if _route_ends_at_destination_city(route):
+        return _norm_kw_value(destination_city) in _route_structured_keys(route, "destination_city_country", "cities")
 
     return False
 
@@ -928,68 +1388,495 @@ def _last_segment_matches_destination_country(route: Dict[str, Any], destination
     if not _route_matches_destination_country_strict(route, destination_country):
         return False
 
-    segments = _path_segments(route)
-    if not segments:
+    keys = _route_segment_keys(route, is_port=False)
+    if not keys:
         return False
 
-    last_seg = segments[-1]
-
-    if _segment_matches_keywords(last_seg, [destination_country], is_port=False):
-        return True
-
-    structured_cities = _route_structured_cities(route, "destination_city_country")
-    if structured_cities and _segment_matches_keywords(last_seg, structured_cities, is_port=False):
+    if _segment_key_matches(keys[-1], _keywords_matcher([destination_country], is_port=False)):
         return True
 
-    return False
+    return _route_ends_at_destination_city(route)
 
 
 def _ordered_waypoint_match(route: Dict[str, Any], value: str, is_port: bool = False) -> bool:
-    segments = _path_segments(route)
-    if not segments or not value:
+    keys = _route_segment_keys(route, is_port=is_port)
+    if not keys or not value:
         return False
-    return _any_segment_matches_text(segments, value, is_port=is_port)
+    matcher = _keywords_matcher([value], is_port=is_port)
+    return any(_segment_key_matches(seg, matcher) for seg in keys)
 
 
 def _kw_score_exact(value: Any, keywords: List[str], pts: int, is_port: bool = False) -> int:
     return pts if _value_matches_keywords(value, keywords, is_port=is_port) else 0
 
 
-def route_base_match(
-    pol: str,
-    pod: str,
-    route: dict,
-    origin_city: str = "",
-    origin_country: str = "",
-    destination_city: str = "",
-    destination_country: str = "",
-    transit_borders: Optional[List[str]] = None,
-    allow_reverse: bool = False
-) -> Tuple[bool, bool, int]:
-    transit_borders = transit_borders or []
-    segments = _path_segments(route)
+# -------------------------
+# COMPILED ROUTE CATALOG
+# routes.json is parsed and normalized once; request threads only read
+# the current catalog. A cheap stat() per lookup picks up edits.
+# -------------------------
+@dataclass(frozen=True)
+class RouteCatalog:
+    """
+    One compiled version of routes.json.
+    Routes are RouteRecords carrying their derived fields (route_type,
+    modes, labels, sort keys, pre-normalized keywords and path segments).
+    Never mutated after it is built.
+    """
+    routes: Tuple["RouteRecord", ...]
+    index: "RouteIndex"
+    graph: "RouteGraph"
+    version: str
+    file_signature: Tuple[int, int]
+    loaded_at: str
 
-    user_has_origin_city = bool(canon(origin_city))
-    user_has_origin_country = bool(canon(origin_country))
-    user_has_pol = bool(normalize_location_key(pol))
-    user_has_pod = bool(normalize_location_key(pod))
-    user_has_destination_city = bool(canon(destination_city))
-    user_has_destination_country = bool(canon(destination_country))
 
-    # -------------------------
-    # HARD START MATCH
-    # -------------------------
-    start_ok = False
-    score = 0
+@dataclass(frozen=True)
+class RouteIndex:
+    """
+    Inverted indexes over a compiled catalog: normalized key -> positions
+    in RouteCatalog.routes. They only prune; every candidate still goes
+    through route_base_match(), so results do not change.
+    """
+    origin_country: Dict[str, frozenset]
+    origin_city_tokens: Dict[str, frozenset]
+    pol: Dict[str, frozenset]
+    destination_city: Dict[str, frozenset]
+    destination_country: Dict[str, frozenset]
+    end_tokens: Dict[str, frozenset]
+    end_is_destination_city: frozenset
 
-    if user_has_origin_country:
-        if not _route_matches_origin_country_strict(route, origin_country):
-            return False, False, 0
-        score += 40
 
-    if user_has_origin_city:
-        if not _route_matches_origin_city_strict(route, origin_city):
-            return False, False, 0
+_route_catalog: Optional[RouteCatalog] = None
+_route_catalog_lock = threading.Lock()
+_route_catalog_stats: Dict[str, int] = {"reloads": 0, "unchanged": 0, "snapshot_loads": 0, "errors": 0}
+
+# Compiled catalog pickled next to the other worker caches, so a boot (or a
+# sibling worker) skips parsing and compiling routes.json. Bump the format
+# whenever compile_route() / the index or graph layout changes; the header
+# also carries the code fingerprint, so any deploy invalidates it anyway.
+ROUTE_CATALOG_SNAPSHOT_FILE = "routes_catalog.pkl"
+ROUTE_CATALOG_SNAPSHOT_FORMAT = 3
+
+
+@dataclass(frozen=True)
+class RouteRecord:
+    """
+    One compiled route: the routes.json entry plus everything matching,
+    sorting and /api/routes serialization need, computed once at load.
+    Slotted and immutable, so every request shares the same records.
+    """
+    __slots__ = (
+        "raw", "route_id", "route_type", "modes", "mode_label", "route_status", "status_label",
+        "tt_key", "status_rank", "specificity_rank", "segments", "segment_port_keys",
+        "keyword_sets", "structured", "structured_keys", "pol_matcher",
+        "ends_at_destination_city", "payload",
+    )
+    raw: Dict[str, Any]
+    route_id: Any
+    route_type: str
+    modes: Tuple[str, ...]
+    mode_label: str
+    route_status: str
+    status_label: str
+    tt_key: Tuple[int, int]
+    status_rank: int
+    specificity_rank: int
+    segments: Tuple[str, ...]
+    segment_port_keys: Tuple[str, ...]
+    keyword_sets: Dict[str, frozenset]
+    structured: Dict[Tuple[str, str], Tuple[str, ...]]
+    structured_keys: Dict[Tuple[str, str], frozenset]
+    pol_matcher: Optional[re.Pattern]
+    ends_at_destination_city: bool
+    payload: Tuple[Tuple[str, Any], ...]  # /api/routes fields except is_best
+
+    def __reduce__(self):
+        # frozen + __slots__ cannot be restored attribute by attribute
+        return (self.__class__, tuple(getattr(self, f.name) for f in fields(self)))
+
+    def as_route_dict(self) -> Dict[str, Any]:
+        """
+        The dict shape get_matching_routes() returns (raw route + derived fields).
+        """
+        rr = dict(self.raw)
+        rr["is_recent"] = False
+        rr["is_custom"] = False
+        rr["is_reverse"] = False
+        rr["route_type"] = self.route_type
+        rr["modes"] = list(self.modes)
+        rr["mode_label"] = self.mode_label
+        rr["status_label"] = self.status_label
+        rr["path"] = self.raw.get("path", "")
+        rr["route_status"] = self.route_status
+        rr["_tt_key"] = self.tt_key
+        return rr
+
+
+def compile_route(route: Dict[str, Any]) -> RouteRecord:
+    route_type = normalize_route_type(route.get("route_type"))
+    modes = tuple(normalize_route_modes(route))
+    mode_label = route_mode_label(route)
+    route_status = normalize_route_status(route.get("route_status"))
+    status_label = route_status_label(route)
+    segments = _path_segments(route)
+    keyword_sets = {field: _route_keyword_set(route, field) for field in ROUTE_KEYWORD_FIELDS}
+    structured = {
+        (side_key, kind): _route_structured_values(route, side_key, kind)
+        for side_key in ("origin_city_country", "destination_city_country")
+        for kind in ("cities", "countries")
+    }
+
+    tt = route.get("transit_time_days") if isinstance(route.get("transit_time_days"), dict) else {}
+    payload = (
+        ("id", str(route.get("id", ""))),
+        ("title", route.get("title", "") or f"Route {route.get('id','')}"),
+        ("path", route.get("path", "") or ""),
+        ("route_status", route_status),
+        ("status_label", status_label),
+        ("route_type", route_type),
+        ("mode_label", mode_label),
+        ("modes", modes),
+        ("is_recent", False),
+        ("transit_min", tt.get("min")),
+        ("transit_max", tt.get("max")),
+    )
+
+    return RouteRecord(
+        raw=route,
+        route_id=route.get("id"),
+        route_type=route_type,
+        modes=modes,
+        mode_label=mode_label,
+        route_status=route_status,
+        status_label=status_label,
+        tt_key=transit_time_key(route),
+        status_rank=route_status_rank(route_status),
+        specificity_rank=route_specificity_rank(route),
+        segments=segments,
+        segment_port_keys=tuple(normalize_location_key(seg) for seg in segments),
+        keyword_sets=keyword_sets,
+        structured=structured,
+        structured_keys={k: frozenset(canon(x) for x in vals) for k, vals in structured.items()},
+        # segment matching: one compiled matcher for the POL keyword list
+        pol_matcher=_keyword_matcher(tuple(sorted(keyword_sets["pol_keywords"]))),
+        ends_at_destination_city=_route_ends_at_destination_city(route),
+        payload=payload,
+    )
+
+
+def route_record_payload(record: RouteRecord, is_best: bool) -> Dict[str, Any]:
+    row = dict(record.payload)
+    row["is_best"] = is_best
+    return row
+
+
+_ROUTE_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _index_add(index: Dict[str, set], keys: Any, pos: int):
+    for k in keys:
+        index.setdefault(k, set()).add(pos)
+
+
+def build_route_index(routes: Tuple[Dict[str, Any], ...]) -> RouteIndex:
+    origin_country: Dict[str, set] = {}
+    origin_city_tokens: Dict[str, set] = {}
+    pol: Dict[str, set] = {}
+    destination_city: Dict[str, set] = {}
+    destination_country: Dict[str, set] = {}
+    end_tokens: Dict[str, set] = {}
+    end_is_destination_city = set()
+
+    for pos, r in enumerate(routes):
+        # same precedence as the *_strict matchers: structured values win over keywords
+        if _route_structured_countries(r, "origin_city_country"):
+            _index_add(origin_country, _route_structured_keys(r, "origin_city_country", "countries"), pos)
+        else:
+            _index_add(origin_country, _route_keyword_set(r, "origin_country_keywords"), pos)
+
+        if _route_structured_countries(r, "destination_city_country"):
+            _index_add(destination_country, _route_structured_keys(r, "destination_city_country", "countries"), pos)
+        else:
+            _index_add(destination_country, _route_keyword_set(r, "destination_country_keywords"), pos)
+
+        _index_add(pol, _route_keyword_set(r, "pol_keywords"), pos)
+        _index_add(destination_city, _route_keyword_set(r, "destination_city_keywords"), pos)
+        _index_add(destination_city, _route_structured_keys(r, "destination_city_country", "cities"), pos)
+
+        segments = _path_segments(r)
+        if not segments:
+            continue
+        # a word-bounded match means every [a-z0-9] run of the query is a whole run of the segment
+        _index_add(origin_city_tokens, _ROUTE_TOKEN_RE.findall(segments[0]), pos)
+        _index_add(end_tokens, _ROUTE_TOKEN_RE.findall(normalize_location_key(segments[-1])), pos)
+
+        if _route_ends_at_destination_city(r):
+            end_is_destination_city.add(pos)
+
+    def freeze(index: Dict[str, set]) -> Dict[str, frozenset]:
+        return {k: frozenset(v) for k, v in index.items()}
+
+    return RouteIndex(
+        origin_country=freeze(origin_country),
+        origin_city_tokens=freeze(origin_city_tokens),
+        pol=freeze(pol),
+        destination_city=freeze(destination_city),
+        destination_country=freeze(destination_country),
+        end_tokens=freeze(end_tokens),
+        end_is_destination_city=frozenset(end_is_destination_city),
+    )
+
+
+def _token_candidates(index: Dict[str, frozenset], text: str) -> Optional[frozenset]:
+    """
+    Routes whose indexed segment contains every token of text.
+    None when text has no tokens (cannot prune).
+    """
+    tokens = set(_ROUTE_TOKEN_RE.findall(text))
+    if not tokens:
+        return None
+    postings = sorted((index.get(t, frozenset()) for t in tokens), key=len)
+    out = postings[0]
+    for p in postings[1:]:
+        if not out:
+            break
+        out = out & p
+    return out
+
+
+def route_candidate_positions(
+    catalog: RouteCatalog,
+    pol: str,
+    pod: str,
+    origin_city: str = "",
+    origin_country: str = "",
+    destination_city: str = "",
+    destination_country: str = "",
+) -> List[int]:
+    """
+    Positions of routes that can pass the hard start/end checks of
+    route_base_match(), in catalog order. Mirrors its branch order.
+    """
+    index = catalog.index
+    pol_key = _norm_kw_value(pol, is_port=True)
+    pod_key = _norm_kw_value(pod, is_port=True)
+    o_city = _norm_kw_value(origin_city)
+    o_country = _norm_kw_value(origin_country)
+    d_city = _norm_kw_value(destination_city)
+    d_country = _norm_kw_value(destination_country)
+
+    constraints: List[frozenset] = []
+
+    if o_country:
+        constraints.append(index.origin_country.get(o_country, frozenset()))
+
+    if o_city:
+        found = _token_candidates(index.origin_city_tokens, o_city)
+        if found is not None:
+            constraints.append(found)
+    elif pol_key and not o_country:
+        constraints.append(index.pol.get(pol_key, frozenset()))
+    elif not o_country:
+        return []
+
+    end_key = ""
+    if d_city:
+        constraints.append(index.destination_city.get(d_city, frozenset()))
+    elif d_country:
+        constraints.append(index.destination_country.get(d_country, frozenset()))
+    elif pod_key:
+        end_key = pod_key
+    elif pol_key and (o_city or o_country):
+        end_key = pol_key
+
+    if end_key:
+        found = _token_candidates(index.end_tokens, end_key)
+        if found is not None:
+            constraints.append(found | index.end_is_destination_city)
+
+    if not constraints:
+        return list(range(len(catalog.routes)))
+
+    constraints.sort(key=len)
+    out = constraints[0]
+    for c in constraints[1:]:
+        if not out:
+            break
+        out = out & c
+    return sorted(out)
+
+
+def _routes_file_signature() -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(ROUTES_JSON_FILE)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _empty_route_catalog(signature: Tuple[int, int]) -> RouteCatalog:
+    return RouteCatalog(
+        routes=(),
+        index=build_route_index(()),
+        graph=build_route_graph(()),
+        version="",
+        file_signature=signature,
+        loaded_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+def _route_catalog_snapshot_header(signature: Tuple[int, int]) -> Dict[str, Any]:
+    return {
+        "format": ROUTE_CATALOG_SNAPSHOT_FORMAT,
+        "code": _code_fingerprint(),
+        "source": os.path.abspath(ROUTES_JSON_FILE),
+        "source_signature": list(signature),
+    }
+
+
+def _load_route_catalog_snapshot(signature: Tuple[int, int]) -> Optional[RouteCatalog]:
+    """
+    The pickled catalog, if it was compiled from exactly this routes.json
+    (same path, mtime and size) by this code; else None. Only read from a
+    private cache dir (see _open_private_cache_file).
+    """
+    path = _cache_path(ROUTE_CATALOG_SNAPSHOT_FILE)
+    try:
+        with _open_private_cache_file(path) as f:
+            # header first, so a stale snapshot is rejected without unpickling the catalog
+            if pickle.load(f) != _route_catalog_snapshot_header(signature):
+                return None
+            catalog = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print("Ignoring unreadable routes catalog snapshot:", e)
+        return None
+
+    if not isinstance(catalog, RouteCatalog):
+        return None
+    return replace(catalog, file_signature=signature)
+
+
+def _write_route_catalog_snapshot(catalog: RouteCatalog):
+    buf = io.BytesIO()
+    pickle.dump(_route_catalog_snapshot_header(catalog.file_signature), buf, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.dump(catalog, buf, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        _atomic_write_bytes(_cache_path(ROUTE_CATALOG_SNAPSHOT_FILE), buf.getvalue())
+    except Exception as e:
+        print("Could not write routes catalog snapshot:", e)
+
+
+def _build_route_catalog(signature: Tuple[int, int]) -> RouteCatalog:
+    snapshot = _load_route_catalog_snapshot(signature)
+    if snapshot is not None:
+        _route_catalog_stats["snapshot_loads"] += 1
+        return snapshot
+
+    with open(ROUTES_JSON_FILE, "rb") as f:
+        content = f.read()
+
+    version = hashlib.sha1(content).hexdigest()[:16]
+    current = _route_catalog
+    if current is not None and current.version == version:
+        # touched but not edited -> keep the compiled routes
+        _route_catalog_stats["unchanged"] += 1
+        catalog = replace(current, file_signature=signature)
+        _write_route_catalog_snapshot(catalog)
+        return catalog
+
+    routes = tuple(compile_route(r) for r in _routes_from_payload(json.loads(content.decode("utf-8"))))
+    _route_catalog_stats["reloads"] += 1
+    catalog = RouteCatalog(
+        routes=routes,
+        index=build_route_index(routes),
+        graph=build_route_graph(routes),
+        version=version,
+        file_signature=signature,
+        loaded_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+    )
+    _write_route_catalog_snapshot(catalog)
+    return catalog
+
+
+def get_route_catalog() -> RouteCatalog:
+    """
+    Current compiled catalog; rebuilt only when routes.json's mtime/size
+    change (and its content hash with them). A broken edit keeps the last
+    good catalog.
+    """
+    global _route_catalog
+
+    signature = _routes_file_signature() or (0, 0)
+    current = _route_catalog
+    if current is not None and current.file_signature == signature:
+        return current
+
+    with _route_catalog_lock:
+        current = _route_catalog
+        if current is not None and current.file_signature == signature:
+            return current
+
+        if signature == (0, 0):
+            _route_catalog = _empty_route_catalog(signature)
+            return _route_catalog
+
+        try:
+            _route_catalog = _build_route_catalog(signature)
+        except Exception as e:
+            print("Error loading routes.json:", e)
+            _route_catalog_stats["errors"] += 1
+            _route_catalog = replace(current or _empty_route_catalog(signature), file_signature=signature)
+        return _route_catalog
+
+
+def get_route_catalog_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = dict(_route_catalog_stats)
+    catalog = _route_catalog
+    stats["version"] = catalog.version if catalog else ""
+    stats["routes"] = len(catalog.routes) if catalog else 0
+    stats["graph_nodes"] = len(catalog.graph.edges) if catalog else 0
+    stats["loaded_at"] = catalog.loaded_at if catalog else None
+    return stats
+
+
+def route_base_match(
+    pol: str,
+    pod: str,
+    route: dict,
+    origin_city: str = "",
+    origin_country: str = "",
+    destination_city: str = "",
+    destination_country: str = "",
+    transit_borders: Optional[List[str]] = None,
+    allow_reverse: bool = False
+) -> Tuple[bool, bool, int]:
+    transit_borders = transit_borders or []
+    segments = _path_segments(route)
+
+    user_has_origin_city = bool(_norm_kw_value(origin_city))
+    user_has_origin_country = bool(_norm_kw_value(origin_country))
+    user_has_pol = bool(_norm_kw_value(pol, is_port=True))
+    user_has_pod = bool(_norm_kw_value(pod, is_port=True))
+    user_has_destination_city = bool(_norm_kw_value(destination_city))
+    user_has_destination_country = bool(_norm_kw_value(destination_country))
+
+    # -------------------------
+    # HARD START MATCH
+    # -------------------------
+    start_ok = False
+    score = 0
+
+    if user_has_origin_country:
+        if not _route_matches_origin_country_strict(route, origin_country):
+            return False, False, 0
+        score += 40
+
+    if user_has_origin_city:
+        if not _route_matches_origin_city_strict(route, origin_city):
+            return False, False, 0
         if not _first_segment_matches_origin_city(route, origin_city):
             return False, False, 0
         start_ok = True
@@ -1066,116 +1953,887 @@ def route_base_match(
         else:
             score += 5  # alternative route without same POL
 
-    if user_has_pod and (user_has_destination_city or user_has_destination_country):
-        if _route_matches_pod_strict(route, pod) or _ordered_waypoint_match(route, pod, is_port=True):
-            score += 35
-        else:
-            score += 5  # alternative route without same POD
+    if user_has_pod and (user_has_destination_city or user_has_destination_country):
+        if _route_matches_pod_strict(route, pod) or _ordered_waypoint_match(route, pod, is_port=True):
+            score += 35
+        else:
+            score += 5  # alternative route without same POD
+
+    # transit borders: optional boost
+    if transit_borders:
+        for b in transit_borders:
+            if _route_has_keyword(route, "borders", b):
+                score += 20
+                break
+
+    return True, False, int(score)
+
+
+def route_match_score_bound(
+    pol: str,
+    pod: str,
+    origin_city: str = "",
+    origin_country: str = "",
+    destination_city: str = "",
+    destination_country: str = "",
+    transit_borders: Optional[List[str]] = None
+) -> int:
+    """
+    Highest score route_base_match() can give any route for this query:
+    the start/end points are fixed by which fields are filled, only the
+    waypoint and border bonuses depend on the route (counted at their max).
+    """
+    has_origin_city = bool(_norm_kw_value(origin_city))
+    has_origin_country = bool(_norm_kw_value(origin_country))
+    has_pol = bool(_norm_kw_value(pol, is_port=True))
+    has_pod = bool(_norm_kw_value(pod, is_port=True))
+    has_destination_city = bool(_norm_kw_value(destination_city))
+    has_destination_country = bool(_norm_kw_value(destination_country))
+
+    score = 40 if has_origin_country else 0
+    if has_origin_city or (has_pol and not has_origin_country):
+        score += 120
+    elif has_origin_country:
+        score += 20
+
+    if has_destination_city:
+        score += 120
+    elif has_destination_country:
+        score += 90
+    elif has_pod or (has_pol and (has_origin_city or has_origin_country)):
+        score += 80
+
+    has_destination = has_destination_city or has_destination_country
+    if has_pol and (has_origin_city or has_origin_country) and has_destination:
+        score += 35
+    if has_pod and has_destination:
+        score += 35
+    if transit_borders:
+        score += 20
+    return score
+
+
+def rank_route_records(
+    pol: str,
+    pod: str,
+    origin_city: str = "",
+    origin_country: str = "",
+    destination_city: str = "",
+    destination_country: str = "",
+    transit_borders: Optional[List[str]] = None,
+    catalog: Optional[RouteCatalog] = None,
+    limit: Optional[int] = None,
+    candidates: Optional[List[int]] = None
+) -> List[Tuple[RouteRecord, int]]:
+    """
+    Matching (record, match score) pairs, best first. With limit, only the
+    best `limit` routes are kept; ordering is the same as the head of the
+    full list because the catalog position breaks ties. Candidates are then
+    visited best-possible first (score bound from route_match_score_bound)
+    and the walk stops once none of the rest can make the top `limit`.
+    `candidates` are precomputed route_candidate_positions() for the same
+    locations.
+    """
+    if catalog is None:
+        catalog = get_route_catalog()
+    transit_borders = transit_borders or []
+
+    # (sort key..., catalog position, score)
+    scored: List[Tuple[int, int, int, Tuple[int, int], int, int]] = []
+
+    if candidates is None:
+        candidates = route_candidate_positions(
+            catalog,
+            pol=pol,
+            pod=pod,
+            origin_city=origin_city,
+            origin_country=origin_country,
+            destination_city=destination_city,
+            destination_country=destination_country,
+        )
+    routes = catalog.routes
+    bounded = limit is not None and 0 < limit < len(candidates)
+    if bounded:
+        # with the score at its bound, the sort key only varies with these
+        candidates = sorted(
+            candidates,
+            key=lambda p: (routes[p].status_rank, routes[p].specificity_rank, routes[p].tt_key, p),
+        )
+        best_score = route_match_score_bound(
+            pol, pod, origin_city, origin_country, destination_city, destination_country, transit_borders
+        )
+
+    for pos in candidates:
+        r = routes[pos]
+        if bounded and len(scored) == limit:
+            if (r.status_rank, -best_score, r.specificity_rank, r.tt_key, pos) > scored[-1]:
+                break
+        ok, is_reverse, match_score = route_base_match(
+            pol=pol,
+            pod=pod,
+            route=r,
+            origin_city=origin_city,
+            origin_country=origin_country,
+            destination_city=destination_city,
+            destination_country=destination_country,
+            transit_borders=transit_borders,
+            allow_reverse=False,
+        )
+        if not ok:
+            continue
+
+        key = (r.status_rank, -int(match_score), r.specificity_rank, r.tt_key, pos, int(match_score))
+        if bounded:
+            # scored stays sorted and at most `limit` long
+            bisect.insort(scored, key)
+            del scored[limit:]
+        else:
+            scored.append(key)
+
+    if not bounded:
+        scored.sort()
+
+    return [(catalog.routes[pos], match_score) for *_key, pos, match_score in scored]
+
+
+def get_matching_routes(
+    pol: str,
+    pod: str,
+    origin_city: str = "",
+    origin_country: str = "",
+    destination_city: str = "",
+    destination_country: str = "",
+    transit_borders: Optional[List[str]] = None,
+    catalog: Optional[RouteCatalog] = None,
+    limit: Optional[int] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Matching routes as dicts, best first (see rank_route_records). Dicts are
+    only built for the routes that are returned.
+    """
+    ranked = rank_route_records(
+        pol=pol,
+        pod=pod,
+        origin_city=origin_city,
+        origin_country=origin_country,
+        destination_city=destination_city,
+        destination_country=destination_country,
+        transit_borders=transit_borders,
+        catalog=catalog,
+        limit=limit,
+    )
+    if not ranked:
+        return [], None
+
+    best_id = ranked[0][0].route_id
+    matched: List[Dict[str, Any]] = []
+    for record, match_score in ranked:
+        rr = record.as_route_dict()
+        rr["_match_score"] = match_score
+        rr["is_best"] = (record.route_id == best_id)
+        matched.append(rr)
+
+    return matched, best_id
+# -------------------------
+# ROUTE GRAPH (composed itineraries)
+# Every path segment becomes a node; riding a route from segment i to a
+# later segment j is an edge. routes.json has no per-leg times, so a leg
+# is charged the full transit time of the route it is taken from (never
+# promises more than the authored route). Shortest-transit search then
+# composes legs of different routes into itineraries nobody hand-authored.
+# -------------------------
+_ROUTE_NODE_NOISE_RE = re.compile(r"\b(border|crossing|final|city)\b")
+_ROUTE_NODE_ALTERNATIVES_RE = re.compile(r"\s*/\s*|\s+or\s+")
+
+
+@dataclass(frozen=True)
+class RouteGraph:
+    """
+    edges: node -> ((to_node, route_pos, from_seg, to_seg, days_min, days_max), ...)
+    node_tokens: [a-z0-9] token -> nodes containing it (to resolve user text)
+    authored_paths: route_path_key() of every catalog route
+    """
+    edges: Dict[str, Tuple[Tuple[str, int, int, int, float, float], ...]]
+    node_tokens: Dict[str, frozenset]
+    authored_paths: frozenset
+
+
+def route_node_keys(text: Any) -> Tuple[str, ...]:
+    """
+    Graph node keys for one path segment or user location.
+    'Torkham or Chaman' and 'Karachi / Port Qasim POD' name alternatives,
+    so they map to several nodes.
+    """
+    t = re.sub(r"\([^)]*\)", " ", canon(text)).strip(" .")
+    keys: List[str] = []
+    for alt in _ROUTE_NODE_ALTERNATIVES_RE.split(t):
+        k = normalize_location_key(_ROUTE_NODE_NOISE_RE.sub(" ", alt)).strip(" .-")
+        if k and k not in keys:
+            keys.append(k)
+    return tuple(keys)
+
+
+def _route_segment_labels(route: Dict[str, Any]) -> List[str]:
+    raw = str(route.get("path", "") or "").strip()
+    return [p.strip().rstrip(".").strip() for p in raw.split("→") if canon(p)]
+
+
+def route_path_key(route: Dict[str, Any]) -> Tuple[str, ...]:
+    """Canonical segments of a route's path, to spot the same path under another id."""
+    return tuple(canon(label) for label in _route_segment_labels(route))
+
+
+def build_route_graph(routes: Tuple[Dict[str, Any], ...]) -> RouteGraph:
+    edges: Dict[str, List[Tuple[str, int, int, int, float, float]]] = {}
+
+    for pos, r in enumerate(routes):
+        if r.route_status == "closed":
+            continue
+        tt_min, tt_max = r.tt_key
+        if tt_min >= 10**9:
+            continue
+        if tt_max >= 10**9:
+            tt_max = tt_min
+
+        seg_nodes = [route_node_keys(seg) for seg in _path_segments(r)]
+        hops = len(seg_nodes) - 1
+        if hops < 1:
+            continue
+
+        for i in range(hops):
+            for j in range(i + 1, hops + 1):
+                for a in seg_nodes[i]:
+                    for b in seg_nodes[j]:
+                        if a != b:
+                            edges.setdefault(a, []).append((b, pos, i, j, float(tt_min), float(tt_max)))
+        for keys in seg_nodes:
+            for k in keys:
+                edges.setdefault(k, [])
+
+    node_tokens: Dict[str, set] = {}
+    for node in edges:
+        _index_add(node_tokens, _ROUTE_TOKEN_RE.findall(node), node)
+
+    return RouteGraph(
+        edges={k: tuple(v) for k, v in edges.items()},
+        node_tokens={k: frozenset(v) for k, v in node_tokens.items()},
+        authored_paths=frozenset(route_path_key(r.raw) for r in routes),
+    )
+
+
+def resolve_route_nodes(graph: RouteGraph, value: str) -> List[str]:
+    """
+    Graph nodes whose name contains the user's location as whole words.
+    """
+    found: List[str] = []
+    for key in route_node_keys(value):
+        candidates = _token_candidates(graph.node_tokens, key)
+        matcher = _keyword_matcher((key,))
+        for node in sorted(candidates or ()):
+            if node not in found and _segment_key_matches(node, matcher):
+                found.append(node)
+    return found
+
+
+def _shortest_route_legs(
+    graph: RouteGraph,
+    starts: List[str],
+    goals: frozenset,
+    banned_routes: frozenset,
+) -> Optional[List[Tuple[str, int, int, int, float, float]]]:
+    """
+    Multi-source Dijkstra on days (+ ROUTE_COMPOSE_TRANSFER_DAYS per leg).
+    Returns the legs of the cheapest start->goal path, or None.
+    """
+    dist: Dict[str, float] = {}
+    prev: Dict[str, Tuple[str, Tuple[str, int, int, int, float, float]]] = {}
+    heap: List[Tuple[float, str]] = []
+    for node in starts:
+        dist[node] = 0.0
+        heap.append((0.0, node))
+    heapq.heapify(heap)
+
+    while heap:
+        d, node = heapq.heappop(heap)
+        if d > dist.get(node, float("inf")):
+            continue
+        if node in goals and node not in starts:
+            legs = []
+            while node in prev:
+                node, edge = prev[node]
+                legs.append(edge)
+            legs.reverse()
+            return legs
+
+        for edge in graph.edges.get(node, ()):
+            if edge[1] in banned_routes:
+                continue
+            nd = d + edge[4] + ROUTE_COMPOSE_TRANSFER_DAYS
+            if nd < dist.get(edge[0], float("inf")):
+                dist[edge[0]] = nd
+                prev[edge[0]] = (node, edge)
+                heapq.heappush(heap, (nd, edge[0]))
+    return None
+
+
+def _itinerary_from_legs(
+    catalog: RouteCatalog,
+    legs: List[Tuple[str, int, int, int, float, float]],
+) -> Dict[str, Any]:
+    path_labels: List[str] = []
+    leg_info: List[Dict[str, Any]] = []
+    modes: List[str] = []
+    worst = ""
+    for _to, pos, i, j, _dmin, _dmax in legs:
+        r = catalog.routes[pos]
+        labels = _route_segment_labels(r.raw)[i:j + 1]
+        # the junction is shared by consecutive legs
+        path_labels.extend(labels if not path_labels else labels[1:])
+        leg_info.append({"route_id": str(r.raw.get("id", "")), "from": labels[0], "to": labels[-1]})
+        for mode in r.modes:
+            if mode not in modes:
+                modes.append(mode)
+        if not worst or r.status_rank > route_status_rank(worst):
+            worst = r.route_status
+
+    ids = [leg["route_id"] for leg in leg_info]
+    composed = {
+        "id": "C-" + "-".join(ids),
+        "title": f"{path_labels[0]} to {path_labels[-1]} via " + " + ".join(ids),
+        "path": " → ".join(path_labels),
+        "route_status": worst,
+        "modes": modes,
+        "route_type": "composed",
+        "transit_time_days": {
+            "min": int(round(sum(leg[4] for leg in legs))),
+            "max": int(round(sum(leg[5] for leg in legs))),
+        },
+        "legs": leg_info,
+        "is_recent": False,
+        "is_custom": True,
+        "is_reverse": False,
+    }
+    composed["mode_label"] = route_mode_label(composed)
+    composed["status_label"] = route_status_label(composed)
+    composed["_tt_key"] = transit_time_key(composed)
+    return composed
+
+
+def compose_route_itineraries(
+    origin: str,
+    destination: str,
+    limit: int = ROUTE_COMPOSE_MAX_RESULTS,
+    catalog: Optional[RouteCatalog] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Itineraries from origin to destination composed from legs of catalog
+    routes (closed routes are left out of the graph). Alternatives come
+    from re-running the search with each route of a found itinerary banned.
+    Only real compositions (two or more legs) are returned: a single leg is
+    just a stretch of one authored route, which /api/routes already covers.
+    Ranked by route status, then transit days, then number of legs.
+    """
+    if catalog is None:
+        catalog = get_route_catalog()
+    graph = catalog.graph
+    starts = resolve_route_nodes(graph, origin)
+    goals = frozenset(resolve_route_nodes(graph, destination))
+    if not starts or not goals or limit <= 0:
+        return [], None
+
+    found: Dict[Tuple[Tuple[int, int, int], ...], List[Tuple[str, int, int, int, float, float]]] = {}
+    pending: List[frozenset] = [frozenset()]
+    tried = set()
+    searches = 0
+    max_searches = max(6 * limit, 12)
+    while pending and searches < max_searches and len(found) < 3 * limit:
+        banned = pending.pop(0)
+        if banned in tried:
+            continue
+        tried.add(banned)
+        legs = _shortest_route_legs(graph, starts, goals, banned)
+        if legs and len(legs) == 1:
+            # one authored route covers the whole trip: look past it first,
+            # without spending the search budget (each pass bans one more route)
+            pending.insert(0, banned | {legs[0][1]})
+            continue
+        searches += 1
+        if not legs:
+            continue
+        found.setdefault(tuple((leg[1], leg[2], leg[3]) for leg in legs), legs)
+        for leg in legs:
+            pending.append(banned | {leg[1]})
+
+    itineraries = [_itinerary_from_legs(catalog, legs) for legs in found.values()]
+    itineraries.sort(
+        key=lambda x: (
+            route_status_rank(x["route_status"]),
+            x["_tt_key"],
+            len(x["legs"]),
+        )
+    )
+    # authored duplicates (same path under another id) add nothing
+    unique: List[Dict[str, Any]] = []
+    seen_paths = set(graph.authored_paths)
+    for it in itineraries:
+        key = route_path_key(it)
+        if key not in seen_paths:
+            seen_paths.add(key)
+            unique.append(it)
+    itineraries = unique[:limit]
+    if not itineraries:
+        return [], None
+
+    best_id = itineraries[0]["id"]
+    for it in itineraries:
+        it["is_best"] = (it["id"] == best_id)
+    return itineraries, best_id
+
+
+# -------------------------
+# LOCATION SUGGESTIONS (trigram index)
+# Built from routes.json keywords and the price book's POL/POD/city/country
+# columns; rebuilt when either of them changes version.
+# -------------------------
+LOCATION_SUGGEST_ROUTE_FIELDS = {
+    "pol_keywords": "pol",
+    "pod_keywords": "pod",
+    "origin_city_keywords": "city",
+    "destination_city_keywords": "city",
+    "origin_country_keywords": "country",
+    "destination_country_keywords": "country",
+}
+
+LOCATION_SUGGEST_PRICE_COLUMNS = {
+    "POL": "pol",
+    "POD": "pod",
+    "city": "city",
+    "city.1": "city",
+    "pod_city": "city",
+    "country": "country",
+    "country.1": "country",
+    "pod_country": "country",
+}
+
+LOCATION_SUGGEST_KINDS = {"pol", "pod", "city", "country", "border"}
+
+
+@dataclass(frozen=True)
+class LocationSuggestIndex:
+    """
+    entries: (label, canonical key, kinds, occurrences, trigram count)
+    trigrams: trigram -> entry positions
+    """
+    entries: Tuple[Tuple[str, str, frozenset, int, int], ...]
+    trigrams: Dict[str, Tuple[int, ...]]
+    version: Tuple[str, str]
+
+
+_location_suggest_index: Optional[LocationSuggestIndex] = None
+_location_suggest_lock = threading.Lock()
+_location_prices_warmup: Dict[str, Any] = {"pid": None}
+
+
+def _trigrams(key: str) -> set:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _collect_location_names(catalog: RouteCatalog, prices_df: Optional[pd.DataFrame]) -> Dict[str, Dict[str, Any]]:
+    names: Dict[str, Dict[str, Any]] = {}
+
+    def add(value: Any, kind: str):
+        label = re.sub(r"\s+", " ", str(value or "")).strip()
+        key = canon(label)
+        # some border keywords are whole corridors ("A -> B -> C"), not places
+        if not key or key == "nan" or "->" in key or "→" in key:
+            return
+        item = names.setdefault(key, {"label": label, "kinds": set(), "count": 0})
+        # prefer a properly cased spelling for display
+        if item["label"].islower() and not label.islower():
+            item["label"] = label
+        item["kinds"].add(kind)
+        item["count"] += 1
+
+    for r in catalog.routes:
+        for field, kind in LOCATION_SUGGEST_ROUTE_FIELDS.items():
+            for kw in (r.raw.get(field) or []):
+                add(kw, kind)
+        for side_key in ("origin_city_country", "destination_city_country"):
+            for city in _route_structured_cities(r, side_key):
+                add(city, "city")
+            for country in _route_structured_countries(r, side_key):
+                add(country, "country")
+        for border in _route_border_keywords(r):
+            add(border, "border")
+
+    if prices_df is not None:
+        for col, kind in LOCATION_SUGGEST_PRICE_COLUMNS.items():
+            if col in prices_df.columns:
+                for v in prices_df[col].dropna().unique():
+                    add(v, kind)
+
+    return names
+
+
+def build_location_suggest_index(
+    catalog: RouteCatalog,
+    prices_df: Optional[pd.DataFrame],
+    version: Tuple[str, str] = ("", ""),
+) -> LocationSuggestIndex:
+    names = _collect_location_names(catalog, prices_df)
+    entries: List[Tuple[str, str, frozenset, int, int]] = []
+    postings: Dict[str, List[int]] = {}
+    for key in sorted(names):
+        item = names[key]
+        label = item["label"] if not item["label"].islower() else item["label"].title()
+        pos = len(entries)
+        tris = _trigrams(key)
+        entries.append((label, key, frozenset(item["kinds"]), item["count"], len(tris)))
+        for tri in tris:
+            postings.setdefault(tri, []).append(pos)
+
+    return LocationSuggestIndex(
+        entries=tuple(entries),
+        trigrams={k: tuple(v) for k, v in postings.items()},
+        version=version,
+    )
+
+
+def _warm_prices_for_suggestions():
+    """
+    Cold worker: load the price book in the background so suggestions
+    never wait on OneDrive.
+    """
+    pid = os.getpid()
+    with _location_suggest_lock:
+        if _location_prices_warmup["pid"] == pid:
+            return
+        _location_prices_warmup["pid"] = pid
+    threading.Thread(target=get_price_snapshot, name="prices-warmup", daemon=True).start()
+
+
+def get_location_suggest_index() -> LocationSuggestIndex:
+    global _location_suggest_index
+
+    catalog = get_route_catalog()
+    snap = _price_snapshot
+    if snap is None:
+        _warm_prices_for_suggestions()
+    version = (catalog.version, snap.tag if snap is not None else "")
+
+    current = _location_suggest_index
+    if current is not None and current.version == version:
+        return current
+
+    with _location_suggest_lock:
+        current = _location_suggest_index
+        if current is None or current.version != version:
+            _location_suggest_index = build_location_suggest_index(
+                catalog,
+                snap.df if snap is not None else None,
+                version=version,
+            )
+        return _location_suggest_index
+
+
+def suggest_locations(
+    text: str,
+    kind: str = "",
+    limit: int = LOCATION_SUGGEST_LIMIT,
+    index: Optional[LocationSuggestIndex] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Ranked, typo-tolerant suggestions: trigram similarity (Jaccard) plus a
+    bonus for prefix / word-prefix hits, then how often the name is used.
+    """
+    q = canon(text)
+    if not q or limit <= 0:
+        return []
+    if index is None:
+        index = get_location_suggest_index()
+
+    q_tris = _trigrams(q)
+    shared: Dict[int, int] = {}
+    for tri in q_tris:
+        for pos in index.trigrams.get(tri, ()):
+            shared[pos] = shared.get(pos, 0) + 1
+
+    scored: List[Tuple[float, int, str, int]] = []
+    for pos, n in shared.items():
+        label, key, kinds, count, n_tris = index.entries[pos]
+        if kind and kind not in kinds:
+            continue
+        score = n / (len(q_tris) + n_tris - n)
+        if key.startswith(q):
+            score += 1.0
+        elif f" {q}" in f" {key}":
+            score += 0.5
+        elif score < 0.3:
+            continue
+        scored.append((-score, -count, label, pos))
+
+    out = []
+    for neg_score, _count, label, pos in heapq.nsmallest(limit, scored):
+        out.append({
+            "label": label,
+            "kinds": sorted(index.entries[pos][2]),
+            "score": round(-neg_score, 3),
+        })
+    return out
+
+
+# -------------------------
+# ROUTE HISTORY (DISABLED)
+# -------------------------
+def load_routes_history_df() -> pd.DataFrame:
+    return pd.DataFrame(columns=["pol", "pod", "route_text", "created_at"])
+
+
+def save_route_history(pol: str, pod: str, route_text: str):
+    return
+
+
+def get_recent_routes(pol: str, pod: str, limit: int = 5) -> List[Dict[str, Any]]:
+    return []
+
+
+# -------------------------
+# EXCEL HELPERS
+# -------------------------
+@dataclass(frozen=True)
+class PriceSnapshot:
+    """
+    One parsed version of prices_updated.xlsx.
+    Built off the request path and swapped in as a whole; never mutated
+    afterwards, so request threads can read it without locks.
+    """
+    df: pd.DataFrame
+    tag: str
+    loaded_at: str
+    global_validity_col: Optional[str]
+    book: "PriceBook"
+    lanes: Optional["PriceLaneIndex"]
+
+
+_price_snapshot: Optional[PriceSnapshot] = None
+
+_prices_stats_lock = threading.Lock()   # guards _prices_cache_stats
+_prices_reload_lock = threading.Lock()  # one poll / download + parse at a time
+_prices_cache_stats: Dict[str, int] = {
+    "hits": 0,
+    "misses": 0,
+    "shared_loads": 0,
+    "errors": 0,
+}
+
+_price_refresher_lock = threading.Lock()
+_price_refresher_state: Dict[str, Any] = {"pid": None}
+
+
+def _prices_item_tag(meta: Dict[str, Any]) -> str:
+    return str(meta.get("cTag") or meta.get("eTag") or "").strip()
+
+
+def _bump_prices_stat(key: str):
+    with _prices_stats_lock:
+        _prices_cache_stats[key] += 1
+
+
+def get_prices_cache_stats() -> Dict[str, Any]:
+    with _prices_stats_lock:
+        stats: Dict[str, Any] = dict(_prices_cache_stats)
+    snap = _price_snapshot
+    stats["tag"] = snap.tag if snap else ""
+    stats["loaded_at"] = snap.loaded_at if snap else None
+    stats["refresh_interval_seconds"] = PRICES_REFRESH_INTERVAL_SECONDS
+    return stats
+
+
+def build_price_snapshot(df: pd.DataFrame, tag: str, loaded_at: Optional[str] = None) -> PriceSnapshot:
+    book = build_price_book(df)
+    return PriceSnapshot(
+        df=df,
+        tag=tag,
+        loaded_at=loaded_at or datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        global_validity_col=book.validity_col,
+        book=book,
+        lanes=build_price_lane_index(df),
+    )
+
+
+# -------------------------
+# SHARED ON-DISK PRICE SNAPSHOT
+# One worker polls Graph and publishes the parsed frame under
+# APP_CACHE_DIR; sibling workers load that file instead of downloading
+# and parsing prices_updated.xlsx themselves.
+# -------------------------
+PRICE_SNAPSHOT_FILE = "prices_snapshot.pkl"
+PRICE_SNAPSHOT_STAMP_FILE = "prices_snapshot.json"
+PRICE_SNAPSHOT_FORMAT = 1
+
+
+def _read_price_stamp() -> Dict[str, Any]:
+    try:
+        with open(_cache_path(PRICE_SNAPSHOT_STAMP_FILE), "r", encoding="utf-8") as f:
+            stamp = json.load(f)
+    except Exception:
+        return {}
+
+    # written by another deploy / pandas version -> do not trust the pickle
+    if stamp.get("format") != PRICE_SNAPSHOT_FORMAT or stamp.get("pandas") != pd.__version__:
+        return {}
+    return stamp
+
+
+def _write_price_stamp(tag: str, loaded_at: str):
+    stamp = {
+        "format": PRICE_SNAPSHOT_FORMAT,
+        "pandas": pd.__version__,
+        "tag": tag,
+        "loaded_at": loaded_at,
+        "checked_at": time.time(),
+    }
+    _atomic_write_bytes(_cache_path(PRICE_SNAPSHOT_STAMP_FILE), json.dumps(stamp).encode("utf-8"))
+
+
+def _publish_price_snapshot(snap: PriceSnapshot):
+    try:
+        payload = {"tag": snap.tag, "loaded_at": snap.loaded_at, "df": snap.df}
+        _atomic_write_bytes(
+            _cache_path(PRICE_SNAPSHOT_FILE),
+            pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        _write_price_stamp(snap.tag, snap.loaded_at)
+    except Exception as e:
+        print("Could not write shared prices snapshot:", e)
+
+
+def _adopt_shared_price_snapshot(stamp: Dict[str, Any]) -> bool:
+    """
+    Installs the snapshot another worker published, if it is newer than ours.
+    """
+    global _price_snapshot
+
+    tag = str(stamp.get("tag") or "")
+    current = _price_snapshot
+    if not tag or (current is not None and current.tag == tag):
+        return False
+
+    try:
+        with _open_private_cache_file(_cache_path(PRICE_SNAPSHOT_FILE)) as f:
+            payload = pickle.load(f)
+        df = payload["df"]
+        tag = str(payload.get("tag") or "")
+        loaded_at = payload.get("loaded_at")
+    except Exception as e:
+        print("Could not read shared prices snapshot:", e)
+        return False
+
+    if not tag or (current is not None and current.tag == tag):
+        return False
+
+    _price_snapshot = build_price_snapshot(df, tag, loaded_at=loaded_at)
+    _bump_prices_stat("shared_loads")
+    return True
+
+
+def _shared_stamp_is_fresh(stamp: Dict[str, Any]) -> bool:
+    checked_at = float(stamp.get("checked_at") or 0.0)
+    return (time.time() - checked_at) < PRICES_REFRESH_INTERVAL_SECONDS
+
+
+def refresh_price_snapshot() -> bool:
+    """
+    Polls once.
+    1. adopt a newer snapshot a sibling worker already published
+    2. if nobody checked OneDrive within the refresh interval, take the
+       cross-worker lock and do it: a cheap metadata call when the
+       cTag/eTag is unchanged, otherwise download, parse, pre-index,
+       publish to disk and swap the new snapshot in.
+    Returns True if a new snapshot was installed.
+    """
+    global _price_snapshot
 
-    # transit borders: optional boost
-    border_keywords = (
-        route.get("must_borders")
-        or route.get("border_keywords")
-        or route.get("transit_border_keywords")
-        or []
-    )
-    if transit_borders and border_keywords:
-        for b in transit_borders:
-            if _value_matches_keywords(b, border_keywords, is_port=False):
-                score += 20
-                break
+    with _prices_reload_lock:
+        installed = _adopt_shared_price_snapshot(_read_price_stamp())
+        if _price_snapshot is not None and _shared_stamp_is_fresh(_read_price_stamp()):
+            return installed
 
-    return True, False, int(score)
+        # Cold worker must wait for the poller; warm workers just skip this round.
+        with _interprocess_lock("prices_snapshot", blocking=_price_snapshot is None) as got_lock:
+            if not got_lock:
+                return installed
 
+            # somebody may have published while we waited for the lock
+            stamp = _read_price_stamp()
+            installed = _adopt_shared_price_snapshot(stamp) or installed
+            if _price_snapshot is not None and _shared_stamp_is_fresh(stamp):
+                return installed
 
-def get_matching_routes(
-    pol: str,
-    pod: str,
-    origin_city: str = "",
-    origin_country: str = "",
-    destination_city: str = "",
-    destination_country: str = "",
-    transit_borders: Optional[List[str]] = None
-) -> Tuple[List[Dict[str, Any]], Optional[str]]:
-    routes_src = load_routes_json()
-    transit_borders = transit_borders or []
+            tag = _prices_item_tag(get_onedrive_item_metadata(ONEDRIVE_PRICES_PATH))
 
-    matched: List[Dict[str, Any]] = []
+            current = _price_snapshot
+            if current is not None and tag and tag == current.tag:
+                _bump_prices_stat("hits")
+                _write_price_stamp(current.tag, current.loaded_at)
+                return installed
 
-    for r in routes_src:
-        ok, is_reverse, match_score = route_base_match(
-            pol=pol,
-            pod=pod,
-            route=r,
-            origin_city=origin_city,
-            origin_country=origin_country,
-            destination_city=destination_city,
-            destination_country=destination_country,
-            transit_borders=transit_borders,
-            allow_reverse=False,
-        )
-        if not ok:
-            continue
+            content = download_excel_from_onedrive(ONEDRIVE_PRICES_PATH)
 
-        rr = dict(r)
-        rr["is_recent"] = False
-        rr["is_custom"] = False
-        rr["is_reverse"] = False
-        rr["route_type"] = normalize_route_type(rr.get("route_type"))
-        rr["modes"] = normalize_route_modes(rr)
-        rr["mode_label"] = route_mode_label(rr)
-        rr["status_label"] = route_status_label(rr)
-        rr["path"] = rr.get("path", "")
-        rr["route_status"] = normalize_route_status(rr.get("route_status"))
-        rr["_tt_key"] = transit_time_key(rr)
-        rr["_match_score"] = int(match_score)
-        matched.append(rr)
+            # IMPORTANT: your file has 2 sheets → we use FIRST sheet (prices)
+            df = pd.read_excel(io.BytesIO(content), sheet_name=0)
 
-    if not matched:
-        return [], None
+            _price_snapshot = build_price_snapshot(df, tag)
+            _bump_prices_stat("misses")
+            _publish_price_snapshot(_price_snapshot)
+            return True
 
-    matched.sort(
-        key=lambda x: (
-            route_status_rank(x.get("route_status", "")),
-            -int(x.get("_match_score", 0)),
-            route_specificity_rank(x),
-            x.get("_tt_key", (10**9, 10**9))
-        )
-    )
 
-    best_id = matched[0].get("id")
-    for rr in matched:
-        rr["is_best"] = (rr.get("id") == best_id)
+def _price_refresher_loop():
+    while True:
+        time.sleep(PRICES_REFRESH_INTERVAL_SECONDS)
+        try:
+            refresh_price_snapshot()
+        except Exception as e:
+            print("Background prices refresh failed:", e)
+            _bump_prices_stat("errors")
 
-    return matched, best_id
-# -------------------------
-# ROUTE HISTORY (DISABLED)
-# -------------------------
-def load_routes_history_df() -> pd.DataFrame:
-    return pd.DataFrame(columns=["pol", "pod", "route_text", "created_at"])
 
+def start_price_refresher():
+    """
+    Starts the polling thread once per worker process (lazily, so it
+    runs after gunicorn forks).
+    """
+    if PRICES_REFRESH_INTERVAL_SECONDS <= 0:
+        return
 
-def save_route_history(pol: str, pod: str, route_text: str):
-    return
+    pid = os.getpid()
+    with _price_refresher_lock:
+        if _price_refresher_state["pid"] == pid:
+            return
+        _price_refresher_state["pid"] = pid
 
+    threading.Thread(target=_price_refresher_loop, name="prices-refresher", daemon=True).start()
 
-def get_recent_routes(pol: str, pod: str, limit: int = 5) -> List[Dict[str, Any]]:
-    return []
 
+def get_price_snapshot() -> Optional[PriceSnapshot]:
+    """
+    Current price-book snapshot. Never touches the network once the
+    first snapshot exists (unless the refresher is disabled).
+    """
+    start_price_refresher()
 
-# -------------------------
-# EXCEL HELPERS
-# -------------------------
-def load_prices_df():
-    try:
-        content = download_excel_from_onedrive(ONEDRIVE_PRICES_PATH)
+    if _price_snapshot is None or PRICES_REFRESH_INTERVAL_SECONDS <= 0:
+        try:
+            refresh_price_snapshot()
+        except Exception as e:
+            print("Error loading prices from OneDrive:", e)
+            _bump_prices_stat("errors")
 
-        # IMPORTANT: your file has 2 sheets → we use FIRST sheet (prices)
-        return pd.read_excel(io.BytesIO(content), sheet_name=0)
+    # Graph hiccup: keep quoting from the last good snapshot if we have one
+    return _price_snapshot
 
-    except Exception as e:
-        print("Error loading prices from OneDrive:", e)
-        return None
 
 # -------------------------
 # PRICING SHEET SECTION HELPERS
@@ -1227,9 +2885,11 @@ def is_blank_or_unnamed_column(col_name: Any) -> bool:
     return canon(s).startswith("unnamed:")
 
 
+SECTION_MARKER_KEYS = frozenset(canon(x) for x in SECTION_MARKERS + SECTION_END_MARKERS)
+
+
 def is_section_marker_column(col_name: Any) -> bool:
-    c = canon(col_name)
-    return c in {canon(x) for x in SECTION_MARKERS} or c in {canon(x) for x in SECTION_END_MARKERS}
+    return canon(col_name) in SECTION_MARKER_KEYS
 
 
 def find_section_marker_positions(df: pd.DataFrame) -> Dict[str, int]:
@@ -1345,125 +3005,727 @@ def get_validity_column_from_basic_section(df: pd.DataFrame) -> Optional[str]:
         if "validity" in canon(c):
             return c
 
-    return None
+    return None
+
+
+PRICE_LOCATION_COLUMN_CANDIDATES = {
+    "origin_address": ["wareshouse_address"],
+    "origin_city": ["city"],
+    "origin_country": ["country"],
+    "destination_address": ["wareshouse_address.1", "pod_wareshouse_address"],
+    "destination_city": ["city.1", "pod_city"],
+    "destination_country": ["country.1", "pod_country"],
+}
+
+
+def price_location_columns(columns: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Origin / destination address, city and country columns present in
+    `columns` (exact header names, first candidate wins).
+    """
+    present = set(columns)
+    return {
+        role: next((c for c in candidates if c in present), None)
+        for role, candidates in PRICE_LOCATION_COLUMN_CANDIDATES.items()
+    }
+
+
+@dataclass(frozen=True)
+class ShipmentModeLayout:
+    """
+    Columns one shipment mode quotes from (Basic + its sections + routes),
+    or the error to show when the sheet cannot serve that mode.
+    """
+    columns: Tuple[str, ...]
+    error: Optional[str]
+    validity_col: Optional[str]
+    routes_col: Optional[str]
+    location_columns: Dict[str, Optional[str]]
+
+
+@dataclass(frozen=True)
+class PriceBook:
+    """
+    Section layout of one price sheet version: marker positions, the Basic
+    section, the shared validity and routes columns and one precomputed
+    ShipmentModeLayout per SHIPMENT_MODE_TO_SECTIONS entry. Built once per
+    snapshot from the headers only.
+    """
+    section_positions: Dict[str, int]
+    basic_columns: Tuple[str, ...]
+    route_columns: Tuple[str, ...]
+    validity_col: Optional[str]
+    modes: Dict[str, ShipmentModeLayout]
+
+
+def _shipment_mode_layout(
+    df: pd.DataFrame,
+    sections: List[str],
+    basic_cols: List[str],
+    route_cols: List[str],
+    validity_col: Optional[str],
+) -> ShipmentModeLayout:
+    def failed(error: str) -> ShipmentModeLayout:
+        return ShipmentModeLayout(columns=(), error=error, validity_col=None, routes_col=None, location_columns={})
+
+    if not basic_cols:
+        return failed("Basic_Details_Section columns were not found in prices_updated.xlsx.")
+
+    keep_cols: List[str] = []
+
+    for c in basic_cols:
+        if c not in keep_cols:
+            keep_cols.append(c)
+
+    missing_sections: List[str] = []
+
+    for sec in sections:
+        sec_cols = get_section_columns(df, sec)
+        if not sec_cols:
+            missing_sections.append(sec)
+            continue
+
+        for c in sec_cols:
+            if c not in keep_cols:
+                keep_cols.append(c)
+
+    for c in route_cols:
+        if c not in keep_cols:
+            keep_cols.append(c)
+
+    if missing_sections:
+        return failed(
+            "Selected shipment mode section was not found in prices_updated.xlsx: "
+            + ", ".join(missing_sections)
+        )
+
+    if not keep_cols:
+        return failed("No pricing columns found for selected shipment mode.")
+
+    if validity_col and validity_col not in keep_cols:
+        validity_col = next((c for c in keep_cols if canon(c) == canon("validity")), None)
+
+    return ShipmentModeLayout(
+        columns=tuple(keep_cols),
+        error=None,
+        validity_col=validity_col,
+        routes_col=next((c for c in keep_cols if canon(c) == canon("routes")), None),
+        location_columns=price_location_columns(keep_cols),
+    )
+
+
+def build_price_book(df: pd.DataFrame) -> PriceBook:
+    basic_cols = get_basic_section_columns(df)
+    route_cols = get_route_columns(df)
+    validity_col = get_validity_column_from_basic_section(df)
+
+    return PriceBook(
+        section_positions=find_section_marker_positions(df),
+        basic_columns=tuple(basic_cols),
+        route_columns=tuple(route_cols),
+        validity_col=validity_col,
+        modes={
+            mode: _shipment_mode_layout(df, sections, basic_cols, route_cols, validity_col)
+            for mode, sections in SHIPMENT_MODE_TO_SECTIONS.items()
+        },
+    )
+
+
+def shipment_mode_layout(book: PriceBook, shipment_mode: str) -> Tuple[Optional[ShipmentModeLayout], Optional[str]]:
+    """
+    (layout, None) for a quotable shipment mode, else (None, error message).
+    """
+    mode = (shipment_mode or "").strip()
+
+    if not mode:
+        return None, "Please select the shipment mode."
+
+    layout = book.modes.get(mode)
+    if layout is None:
+        return None, f"Unsupported shipment mode selected: {mode}"
+
+    if layout.error:
+        return None, layout.error
+
+    return layout, None
+
+
+# -------------------------
+# PRICE LANE INDEX
+# POL/POD keys normalized once per price-book version, so a quote only
+# compares the user's ports against the distinct keys in the sheet.
+# -------------------------
+@dataclass(frozen=True)
+class PriceLaneIndex:
+    """
+    pol_keys / pod_keys: normalize_location_key() of each row's POL / POD,
+    in row order. lanes: (pol_key, pod_key) -> row positions, ascending.
+    pol_rows: pol_key -> row positions, ascending.
+    """
+    pol_keys: Tuple[str, ...]
+    pod_keys: Tuple[str, ...]
+    lanes: Dict[Tuple[str, str], Tuple[int, ...]]
+    pol_rows: Dict[str, Tuple[int, ...]]
+
+
+def build_price_lane_index(df: pd.DataFrame, pol_col: str = "POL", pod_col: str = "POD") -> Optional[PriceLaneIndex]:
+    if pol_col not in df.columns or pod_col not in df.columns:
+        return None
+
+    pol_keys = tuple(normalize_location_key(x) for x in df[pol_col])
+    pod_keys = tuple(normalize_location_key(x) for x in df[pod_col])
+
+    lanes: Dict[Tuple[str, str], List[int]] = {}
+    pol_rows: Dict[str, List[int]] = {}
+    for pos, lane in enumerate(zip(pol_keys, pod_keys)):
+        lanes.setdefault(lane, []).append(pos)
+        pol_rows.setdefault(lane[0], []).append(pos)
+
+    return PriceLaneIndex(
+        pol_keys=pol_keys,
+        pod_keys=pod_keys,
+        lanes={k: tuple(v) for k, v in lanes.items()},
+        pol_rows={k: tuple(v) for k, v in pol_rows.items()},
+    )
+
+
+def _matching_location_keys(user_value: Any, keys: Any) -> set:
+    """
+    Sheet keys flexible_location_match() would accept for user_value.
+    """
+    u = normalize_location_key(user_value)
+    if not u:
+        return set()
+    return {k for k in keys if k and (u == k or u in k or k in u)}
+
+
+def price_lane_row_positions(lanes: PriceLaneIndex, pol: Any, pod: Any, require_pod: bool = True) -> List[int]:
+    """
+    Row positions whose POL (and, with require_pod, POD) flexibly match,
+    in sheet order. An exact lane hit that no other key matches is a
+    single dict lookup.
+    """
+    pol_keys = _matching_location_keys(pol, lanes.pol_rows)
+    if not pol_keys:
+        return []
+
+    if not require_pod:
+        if len(pol_keys) == 1:
+            return list(lanes.pol_rows[next(iter(pol_keys))])
+        return sorted(pos for k in pol_keys for pos in lanes.pol_rows[k])
+
+    pod_keys = _matching_location_keys(pod, {pod_key for _pol_key, pod_key in lanes.lanes})
+    if not pod_keys:
+        return []
+
+    if len(pol_keys) == 1 and len(pod_keys) == 1:
+        return list(lanes.lanes.get((next(iter(pol_keys)), next(iter(pod_keys))), ()))
+
+    return sorted(
+        pos
+        for (pol_key, pod_key), rows in lanes.lanes.items()
+        if pol_key in pol_keys and pod_key in pod_keys
+        for pos in rows
+    )
+
+
+# -------------------------
+# QUOTE JOURNAL (SQLite, WAL)
+# -------------------------
+QUOTES_JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS quote_records (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    quote_id TEXT,
+    created_at TEXT NOT NULL,
+    source TEXT NOT NULL DEFAULT 'app',
+    record_json TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS quote_line_items (
+    record_seq INTEGER NOT NULL,
+    line_no INTEGER NOT NULL,
+    quote_id TEXT,
+    quote_index INTEGER,
+    quote_title TEXT,
+    name TEXT,
+    cost TEXT,
+    validity TEXT,
+    validity_status TEXT,
+    include_in_total INTEGER,
+    is_grand_total INTEGER,
+    is_display_only_red_row INTEGER,
+    grand_mode TEXT,
+    grand_key TEXT,
+    cost_num REAL,
+    per20_num REAL,
+    per40_num REAL,
+    ship20_num REAL,
+    ship40_num REAL,
+    ship_common_num REAL,
+    unit_count INTEGER,
+    PRIMARY KEY (record_seq, line_no)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_quote_line_items_quote_id ON quote_line_items (quote_id);
+"""
+
+QUOTE_LINE_ITEM_COLUMNS = [
+    "quote_index",
+    "quote_title",
+    "line_no",
+    "name",
+    "cost",
+    "validity",
+    "validity_status",
+    "include_in_total",
+    "is_grand_total",
+    "is_display_only_red_row",
+    "grand_mode",
+    "grand_key",
+    "cost_num",
+    "per20_num",
+    "per40_num",
+    "ship20_num",
+    "ship40_num",
+    "ship_common_num",
+    "unit_count",
+]
+QUOTE_LINE_ITEM_BOOL_FIELDS = {"include_in_total", "is_grand_total", "is_display_only_red_row"}
+
+_journal_local = threading.local()
+_journal_stats_lock = threading.Lock()
+_journal_stats: Dict[str, Any] = {
+    "saved": 0,
+    "exports": 0,
+    "export_errors": 0,
+    "last_error": "",
+}
+
+_exporter_lock = threading.Lock()
+_exporter_state: Dict[str, Any] = {"pid": None}
+
+
+def quote_journal_enabled() -> bool:
+    return bool(QUOTES_JOURNAL_PATH)
+
+
+def get_journal_connection() -> sqlite3.Connection:
+    """
+    One connection per thread (sqlite3 connections are not shared across
+    threads). WAL lets every worker insert while the exporter reads.
+    """
+    conn = getattr(_journal_local, "conn", None)
+    if conn is not None and getattr(_journal_local, "pid", None) == os.getpid():
+        return conn
+
+    if not QUOTES_JOURNAL_PATH:
+        raise RuntimeError("QUOTES_JOURNAL_PATH is not set; point it at a file on persistent storage.")
+
+    journal_path = os.path.abspath(QUOTES_JOURNAL_PATH)
+    temp_dir = os.path.abspath(tempfile.gettempdir())
+    if os.path.commonpath([journal_path, temp_dir]) == temp_dir:
+        raise RuntimeError(f"QUOTES_JOURNAL_PATH ({QUOTES_JOURNAL_PATH}) is in the temp directory; use persistent storage.")
+
+    journal_dir = os.path.dirname(QUOTES_JOURNAL_PATH)
+    if journal_dir:
+        os.makedirs(journal_dir, mode=0o700, exist_ok=True)
+
+    # isolation_level=None -> autocommit; multi-row work uses explicit BEGIN
+    conn = sqlite3.connect(QUOTES_JOURNAL_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.executescript(QUOTES_JOURNAL_SCHEMA)
+
+    _journal_local.conn = conn
+    _journal_local.pid = os.getpid()
+    return conn
+
+
+def _journal_meta_get(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM journal_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _journal_meta_set(conn: sqlite3.Connection, key: str, value: Any):
+    conn.execute(
+        "INSERT INTO journal_meta (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, str(value))
+    )
+
+
+def _json_safe_value(v: Any) -> Any:
+    """
+    Journal encoding of one record value: every NaN / NaT / NA is null,
+    numpy scalars become plain Python numbers / bools and datetimes are
+    tagged so _journal_record_from_json() restores them as datetimes.
+    """
+    if v is None:
+        return None
+    if pd.api.types.is_scalar(v) and pd.isna(v):
+        return None
+    if isinstance(v, np.datetime64):
+        v = pd.Timestamp(v)
+    elif isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, datetime):
+        return {"__datetime__": v.isoformat()}
+    if isinstance(v, date):
+        return {"__date__": v.isoformat()}
+    return v
+
+
+def _json_safe_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    return {str(k): _json_safe_value(v) for k, v in record.items()}
+
+
+def _journal_json_object(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1:
+        if "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        if "__date__" in obj:
+            return date.fromisoformat(obj["__date__"])
+    return obj
+
+
+def _journal_record_from_json(record_json: str) -> Dict[str, Any]:
+    return json.loads(record_json, object_hook=_journal_json_object)
+
+
+def _line_item_db_value(field: str, v: Any) -> Any:
+    if field in QUOTE_LINE_ITEM_BOOL_FIELDS:
+        return 1 if v else 0
+    return None if v == "" else v
+
+
+def _line_item_from_db(field: str, v: Any) -> Any:
+    if field in QUOTE_LINE_ITEM_BOOL_FIELDS:
+        return bool(v)
+    return "" if v is None else v
+
+
+def journal_insert_quote(record: Dict[str, Any], line_items: Optional[List[Dict[str, Any]]] = None) -> int:
+    """
+    Saves one quote header + its line items in a single transaction.
+    Returns the journal sequence number of the header row.
+    """
+    conn = get_journal_connection()
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    quote_id = str(record.get("quote_id") or "")
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.execute(
+            "INSERT INTO quote_records (quote_id, created_at, source, record_json) VALUES (?, ?, ?, ?)",
+            (
+                quote_id,
+                str(record.get("timestamp") or now),
+                "app",
+                json.dumps(_json_safe_record(record), ensure_ascii=False, default=str),
+            )
+        )
+        seq = int(cur.lastrowid)
+
+        cols = ", ".join(QUOTE_LINE_ITEM_COLUMNS)
+        marks = ", ".join("?" for _ in QUOTE_LINE_ITEM_COLUMNS)
+        conn.executemany(
+            f"INSERT INTO quote_line_items (record_seq, quote_id, {cols}) VALUES (?, ?, {marks})",
+            [
+                (seq, quote_id, *[_line_item_db_value(c, item.get(c, "")) for c in QUOTE_LINE_ITEM_COLUMNS])
+                for item in (line_items or [])
+            ]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return seq
+
+
+QUERIES_XLSX_CHANGED_MSG = "queries.xlsx was changed on OneDrive meanwhile; please try again."
+
+
+def upload_queries_excel(df: pd.DataFrame, etag: str = "") -> Tuple[bool, str]:
+    """
+    etag: the version df was built on. The upload only replaces that
+    version ("" = the file must not exist yet).
+    """
+    try:
+        buffer = io.BytesIO()
+        df.to_excel(buffer, index=False)
+        buffer.seek(0)
+
+        condition = {"If-Match": etag} if etag else {"If-None-Match": "*"}
+        upload_excel_to_onedrive(ONEDRIVE_QUERIES_PATH, buffer.read(), extra_headers=condition)
+        return True, ""
+
+    except requests.exceptions.HTTPError as e:
+        status = e.response.status_code if e.response is not None else None
+        if status == 412:
+            return False, QUERIES_XLSX_CHANGED_MSG
+        if status == 409:
+            return False, "Could not save query to queries.xlsx because the file is busy or locked in OneDrive."
+        return False, f"Could not save query to queries.xlsx (HTTP {status})."
+
+    except Exception as e:
+        return False, f"Could not save query to queries.xlsx: {str(e)}"
+
+
+def build_queries_export_df(conn: sqlite3.Connection, after_seq: int = 0) -> Tuple[pd.DataFrame, int]:
+    """
+    The wide queries.xlsx rows for quotes saved after `after_seq`, in save
+    order, each expanded with its normalized line items.
+    Returns (rows, last seq looked at).
+    """
+    items_by_seq: Dict[int, List[Dict[str, Any]]] = {}
+    cols = ", ".join(QUOTE_LINE_ITEM_COLUMNS)
+    for row in conn.execute(
+        f"SELECT record_seq, {cols} FROM quote_line_items WHERE record_seq > ? ORDER BY record_seq, line_no",
+        (after_seq,)
+    ):
+        items_by_seq.setdefault(int(row[0]), []).append({
+            c: _line_item_from_db(c, v) for c, v in zip(QUOTE_LINE_ITEM_COLUMNS, row[1:])
+        })
+
+    records: List[Dict[str, Any]] = []
+    last_seq = after_seq
+    for seq, source, record_json in conn.execute(
+        "SELECT seq, source, record_json FROM quote_records WHERE seq > ? ORDER BY seq",
+        (after_seq,)
+    ):
+        last_seq = int(seq)
+        record = _journal_record_from_json(record_json)
+        if source == "app":
+            record = expand_line_items_into_record(record, items_by_seq.get(int(seq), []))
+        records.append(record)
+
+    return pd.DataFrame(records), last_seq
+
+
+def read_remote_queries_workbook() -> Tuple[pd.DataFrame, str]:
+    """
+    Current queries.xlsx and the eTag of the version read.
+    A missing file is an empty frame with eTag "". Any other failure
+    raises: the exporter must never mistake an unreadable workbook for
+    an empty one and overwrite it.
+    """
+    try:
+        etag = str(get_onedrive_item_metadata(ONEDRIVE_QUERIES_PATH).get("eTag") or "")
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return pd.DataFrame(), ""
+        raise
+
+    content = download_excel_from_onedrive(ONEDRIVE_QUERIES_PATH)
+    return pd.read_excel(io.BytesIO(content), sheet_name=0), etag
 
 
-def select_pricing_columns_for_shipment_mode(
-    df: pd.DataFrame,
-    shipment_mode: str
-) -> Tuple[pd.DataFrame, Optional[str], List[str]]:
-    """
-    Keeps only:
-      - Basic_Details_Section columns
-      - selected shipment mode section columns
-      - routes column
-
-    Examples:
-      Ocean Freight Shipment                                  => Basic + Ocean + routes
-      Railway Shipment                                        => Basic + Railway + routes
-      Land Shipment                                           => Basic + Land + routes
-      Airway                                                  => Basic + Airway + routes
-      Ocean Freight + Land Shipment                           => Basic + Ocean + Land + routes
-      Ocean Freight Shipment + Railway Shipment               => Basic + Ocean + Railway + routes
-      Railway Shipment + Land Shipment                        => Basic + Railway + Land + routes
-      Land Shipment + Airway                                  => Basic + Land + Airway + routes
-      Ocean Freight Shipment + Railway Shipment + Land Shipment => Basic + Ocean + Railway + Land + routes
+def append_rows_to_queries_excel(df_new: pd.DataFrame) -> Tuple[bool, str]:
     """
-    mode = (shipment_mode or "").strip()
+    Saves without a journal: reads queries.xlsx, appends df_new and uploads
+    it only if the workbook is still the version read. If another save got
+    in first, starts over from the new version.
+    """
+    msg = QUERIES_XLSX_CHANGED_MSG
+    for _attempt in range(max(1, QUERIES_APPEND_ATTEMPTS)):
+        try:
+            df_remote, etag = read_remote_queries_workbook()
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            return False, f"Could not read queries.xlsx before saving (HTTP {status})."
+        except Exception as e:
+            return False, f"Could not read queries.xlsx before saving: {str(e)}"
 
-    if not mode:
-        return df.copy(), "Please select the shipment mode.", []
+        ok, msg = upload_queries_excel(pd.concat([df_remote, df_new], ignore_index=True), etag)
+        if ok or msg != QUERIES_XLSX_CHANGED_MSG:
+            return ok, msg
+    return False, msg
 
-    selected_sections = SHIPMENT_MODE_TO_SECTIONS.get(mode)
-    if not selected_sections:
-        return df.copy(), f"Unsupported shipment mode selected: {mode}", []
 
-    basic_cols = get_basic_section_columns(df)
+def export_queries_excel() -> bool:
+    """
+    Appends the quotes saved since the last export to queries.xlsx.
+    The current workbook is read and re-uploaded only if nobody changed
+    it meanwhile (eTag), so rows from other workers / hosts and manual
+    edits are kept. Only one worker per machine exports at a time.
+    Returns True if a new workbook was uploaded.
+    """
+    with _interprocess_lock("queries_export", blocking=False) as got_lock:
+        if not got_lock:
+            return False
 
-    if not basic_cols:
-        return df.copy(), "Basic_Details_Section columns were not found in prices_updated.xlsx.", []
+        conn = get_journal_connection()
+        exported_seq = int(_journal_meta_get(conn, "exported_seq") or 0)
+        df_new, last_seq = build_queries_export_df(conn, after_seq=exported_seq)
+        if df_new.empty:
+            if last_seq != exported_seq:
+                _journal_meta_set(conn, "exported_seq", last_seq)
+            return False
 
-    keep_cols: List[str] = []
+        try:
+            df_remote, etag = read_remote_queries_workbook()
+        except Exception as e:
+            df_remote, etag = None, ""
+            msg = f"Could not read queries.xlsx before exporting: {e}"
+
+        if df_remote is not None:
+            df_final = pd.concat([df_remote, df_new], ignore_index=True)
+            ok, msg = upload_queries_excel(df_final, etag)
+        else:
+            ok = False
 
-    for c in basic_cols:
-        if c not in keep_cols:
-            keep_cols.append(c)
+        if not ok:
+            print("queries.xlsx export failed:", msg)
+            with _journal_stats_lock:
+                _journal_stats["export_errors"] += 1
+                _journal_stats["last_error"] = msg
+            return False
 
-    missing_sections: List[str] = []
+        _journal_meta_set(conn, "exported_seq", last_seq)
+        with _journal_stats_lock:
+            _journal_stats["exports"] += 1
+        return True
 
-    for sec in selected_sections:
-        sec_cols = get_section_columns(df, sec)
-        if not sec_cols:
-            missing_sections.append(sec)
-            continue
 
-        for c in sec_cols:
-            if c not in keep_cols:
-                keep_cols.append(c)
+def _exporter_loop():
+    while True:
+        time.sleep(QUERIES_EXPORT_INTERVAL_SECONDS)
+        try:
+            export_queries_excel()
+        except Exception as e:
+            print("queries.xlsx exporter failed:", e)
+            with _journal_stats_lock:
+                _journal_stats["export_errors"] += 1
+                _journal_stats["last_error"] = str(e)
+
+
+def start_queries_exporter():
+    if not quote_journal_enabled():
+        return
+    pid = os.getpid()
+    with _exporter_lock:
+        if _exporter_state["pid"] == pid:
+            return
+        _exporter_state["pid"] = pid
 
-    for c in get_route_columns(df):
-        if c not in keep_cols:
-            keep_cols.append(c)
+    threading.Thread(target=_exporter_loop, name="queries-exporter", daemon=True).start()
 
-    if missing_sections:
-        return df.copy(), (
-            "Selected shipment mode section was not found in prices_updated.xlsx: "
-            + ", ".join(missing_sections)
-        ), []
 
-    if not keep_cols:
-        return df.copy(), "No pricing columns found for selected shipment mode.", []
+def get_quote_journal_stats() -> Dict[str, Any]:
+    with _journal_stats_lock:
+        stats = dict(_journal_stats)
+    stats["journal_enabled"] = quote_journal_enabled()
+    if not stats["journal_enabled"]:
+        return stats
+    try:
+        conn = get_journal_connection()
+        stats["records"] = int(conn.execute("SELECT COUNT(*) FROM quote_records").fetchone()[0])
+        stats["exported_seq"] = int(_journal_meta_get(conn, "exported_seq") or 0)
+        stats["max_seq"] = int(conn.execute("SELECT COALESCE(MAX(seq), 0) FROM quote_records").fetchone()[0])
+    except Exception as e:
+        stats["journal_error"] = str(e)
+    return stats
+
 
-    return df.loc[:, keep_cols].copy(), None, keep_cols
+def save_to_excel(
+    record: Dict[str, Any],
+    line_items: Optional[List[Dict[str, Any]]] = None
+) -> Tuple[bool, str]:
+    """
+    Saves the quote header + line items. With a quote journal they go into
+    it and the exporter appends them to queries.xlsx later; without one
+    the wide row is appended to queries.xlsx right away.
+    """
+    if not quote_journal_enabled():
+        ok, msg = append_rows_to_queries_excel(
+            pd.DataFrame([expand_line_items_into_record(record, line_items or [])])
+        )
+        if ok:
+            with _journal_stats_lock:
+                _journal_stats["saved"] += 1
+            remember_vocabulary_values(record)
+        return ok, msg
 
-def save_to_excel(record: Dict[str, Any]) -> Tuple[bool, str]:
+    start_queries_exporter()
     try:
-        try:
-            # download existing file
-            content = download_excel_from_onedrive(ONEDRIVE_QUERIES_PATH)
-            df_existing = pd.read_excel(io.BytesIO(content))
-        except Exception:
-            # file doesn't exist yet or cannot be read
-            df_existing = pd.DataFrame()
+        journal_insert_quote(record, line_items)
+        with _journal_stats_lock:
+            _journal_stats["saved"] += 1
+        remember_vocabulary_values(record)
+        return True, ""
+    except Exception as e:
+        print("Could not write quote journal:", e)
+        return False, f"Could not save query to the local quote journal: {str(e)}"
+
+QUOTE_LINE_ITEM_NUM_FIELDS = [
+    "cost_num",
+    "per20_num",
+    "per40_num",
+    "ship20_num",
+    "ship40_num",
+    "ship_common_num",
+    "unit_count",
+]
 
-        df_new = pd.DataFrame([record])
-        df_final = pd.concat([df_existing, df_new], ignore_index=True)
 
-        # save to memory
-        buffer = io.BytesIO()
-        df_final.to_excel(buffer, index=False)
-        buffer.seek(0)
+def build_generated_quote_line_items(rates: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    One normalized line item per generated quote row.
+    Stored in the quote_line_items table instead of as extra
+    generated_price_* columns on the quote record.
+    """
+    items: List[Dict[str, Any]] = []
+    line_no = 1
 
-        # upload back to OneDrive
-        upload_excel_to_onedrive(ONEDRIVE_QUERIES_PATH, buffer.read())
-        return True, ""
+    for quote_idx, quote in enumerate(rates or [], start=1):
+        title = str(quote.get("title", "") or "").strip()
 
-    except requests.exceptions.HTTPError as e:
-        status = e.response.status_code if e.response is not None else None
-        if status == 409:
-            return False, "Could not save query to queries.xlsx because the file is busy or locked in OneDrive."
-        return False, f"Could not save query to queries.xlsx (HTTP {status})."
+        for row in (quote.get("table_rows") or []):
+            if not isinstance(row, dict):
+                continue
+
+            item = {
+                "quote_index": quote_idx,
+                "quote_title": title,
+                "line_no": line_no,
+                "name": str(row.get("name", "") or "").strip(),
+                "cost": str(row.get("cost", "") or "").strip(),
+                "validity": str(row.get("validity", "") or "").strip(),
+                "validity_status": str(row.get("validity_status", "") or "").strip(),
+                "include_in_total": bool(row.get("include_in_total", False)),
+                "is_grand_total": bool(row.get("is_grand_total", False)),
+                "is_display_only_red_row": bool(row.get("is_red_text", False)),
+                "grand_mode": str(row.get("grand_mode", "") or "").strip(),
+                "grand_key": str(row.get("grand_key", "") or "").strip(),
+            }
+            for f in QUOTE_LINE_ITEM_NUM_FIELDS:
+                item[f] = row.get(f, "")
+
+            items.append(item)
+            line_no += 1
+
+    return items
 
-    except Exception as e:
-        return False, f"Could not save query to queries.xlsx: {str(e)}"
 
 def add_generated_quote_prices_to_record(
     record: Dict[str, Any],
     rates: Optional[List[Dict[str, Any]]]
 ) -> Dict[str, Any]:
     """
-    Adds all generated quote line items and grand totals into the same record
-    that is saved to queries.xlsx.
-
-    This saves:
-      - A JSON copy of all generated quote rows
-      - Separate Excel columns for each generated row
-      - Separate Excel columns for grand totals
+    Adds the quote-level summary of the generated quote to the record
+    that is saved to the quote journal:
+      - quote count, titles and match notes
+      - grand totals (text + numeric)
+
+    The individual line items are NOT flattened into the record any more;
+    they are saved separately (build_generated_quote_line_items) and
+    expanded back into generated_price_* columns only when queries.xlsx
+    is exported.
     """
     rates = rates or []
 
-    quote_export: List[Dict[str, Any]] = []
-
     # Default summary columns, so queries.xlsx always has stable columns
     record["generated_quote_count"] = len(rates)
     record["generated_grand_total_per_20ft_container"] = ""
@@ -1473,176 +3735,184 @@ def add_generated_quote_prices_to_record(
     record["generated_grand_total_per_40ft_container_num"] = ""
     record["generated_grand_total_shipment_cost_num"] = ""
 
-    line_no = 1
-
     for quote_idx, quote in enumerate(rates, start=1):
-        title = str(quote.get("title", "") or "").strip()
-        match_note = str(quote.get("match_note", "") or "").strip()
-        table_rows = quote.get("table_rows") or []
+        record[f"generated_quote_{quote_idx}_title"] = str(quote.get("title", "") or "").strip()
+        record[f"generated_quote_{quote_idx}_match_note"] = str(quote.get("match_note", "") or "").strip()
 
-        record[f"generated_quote_{quote_idx}_title"] = title
-        record[f"generated_quote_{quote_idx}_match_note"] = match_note
+    # Easy-to-read grand total columns
+    for item in build_generated_quote_line_items(rates):
+        if not item["is_grand_total"]:
+            continue
 
-        for row in table_rows:
-            if not isinstance(row, dict):
-                continue
+        name_c = canon(item["name"])
+        cost = item["cost"]
+        parsed_total = parse_price_to_float(cost)
+        total_num = float(parsed_total) if parsed_total is not None else ""
 
-            name = str(row.get("name", "") or "").strip()
-            cost = str(row.get("cost", "") or "").strip()
-            validity = str(row.get("validity", "") or "").strip()
-            validity_status = str(row.get("validity_status", "") or "").strip()
-
-            cost_num = row.get("cost_num", "")
-            per20_num = row.get("per20_num", "")
-            per40_num = row.get("per40_num", "")
-            ship20_num = row.get("ship20_num", "")
-            ship40_num = row.get("ship40_num", "")
-            ship_common_num = row.get("ship_common_num", "")
-            unit_count = row.get("unit_count", "")
-
-            include_in_total = bool(row.get("include_in_total", False))
-            is_grand_total = bool(row.get("is_grand_total", False))
-            is_red_text = bool(row.get("is_red_text", False))
-            grand_mode = str(row.get("grand_mode", "") or "").strip()
-            grand_key = str(row.get("grand_key", "") or "").strip()
-
-            # Store all generated rows in JSON too
-            quote_export.append({
-                "quote_index": quote_idx,
-                "quote_title": title,
-                "line_no": line_no,
-                "name": name,
-                "cost": cost,
-                "validity": validity,
-                "validity_status": validity_status,
-                "include_in_total": include_in_total,
-                "is_grand_total": is_grand_total,
-                "is_display_only_red_row": is_red_text,
-                "grand_mode": grand_mode,
-                "grand_key": grand_key,
-                "cost_num": cost_num,
-                "per20_num": per20_num,
-                "per40_num": per40_num,
-                "ship20_num": ship20_num,
-                "ship40_num": ship40_num,
-                "ship_common_num": ship_common_num,
-                "unit_count": unit_count,
-            })
+        if name_c == canon("Grand total per 20ft container"):
+            record["generated_grand_total_per_20ft_container"] = cost
+            record["generated_grand_total_per_20ft_container_num"] = total_num
 
-            # Store each generated row as normal Excel columns too
-            prefix = f"generated_price_{line_no:02d}"
-            record[f"{prefix}_quote_index"] = quote_idx
-            record[f"{prefix}_name"] = name
-            record[f"{prefix}_cost"] = cost
-            record[f"{prefix}_validity"] = validity
-            record[f"{prefix}_validity_status"] = validity_status
-            record[f"{prefix}_include_in_total"] = "Yes" if include_in_total else "No"
-            record[f"{prefix}_is_grand_total"] = "Yes" if is_grand_total else "No"
-            record[f"{prefix}_is_display_only"] = "Yes" if is_red_text else "No"
-            record[f"{prefix}_cost_num"] = cost_num
-            record[f"{prefix}_per20_num"] = per20_num
-            record[f"{prefix}_per40_num"] = per40_num
-            record[f"{prefix}_ship20_num"] = ship20_num
-            record[f"{prefix}_ship40_num"] = ship40_num
-            record[f"{prefix}_ship_common_num"] = ship_common_num
-            record[f"{prefix}_unit_count"] = unit_count
-
-            # Easy-to-read grand total columns
-            name_c = canon(name)
-
-            if is_grand_total:
-                parsed_total = parse_price_to_float(cost)
-
-                if name_c == canon("Grand total per 20ft container"):
-                    record["generated_grand_total_per_20ft_container"] = cost
-                    record["generated_grand_total_per_20ft_container_num"] = (
-                        float(parsed_total) if parsed_total is not None else ""
-                    )
+        elif name_c == canon("Grand total per 40ft container"):
+            record["generated_grand_total_per_40ft_container"] = cost
+            record["generated_grand_total_per_40ft_container_num"] = total_num
 
-                elif name_c == canon("Grand total per 40ft container"):
-                    record["generated_grand_total_per_40ft_container"] = cost
-                    record["generated_grand_total_per_40ft_container_num"] = (
-                        float(parsed_total) if parsed_total is not None else ""
-                    )
+        elif name_c == canon("Grand total shipment cost"):
+            record["generated_grand_total_shipment_cost"] = cost
+            record["generated_grand_total_shipment_cost_num"] = total_num
 
-                elif name_c == canon("Grand total shipment cost"):
-                    record["generated_grand_total_shipment_cost"] = cost
-                    record["generated_grand_total_shipment_cost_num"] = (
-                        float(parsed_total) if parsed_total is not None else ""
-                    )
+    return record
 
-            line_no += 1
 
-    record["generated_quote_prices_json"] = json.dumps(
-        quote_export,
+def expand_line_items_into_record(record: Dict[str, Any], items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Rebuilds the wide queries.xlsx layout for one saved quote:
+      - a JSON copy of all generated quote rows
+      - separate generated_price_NN_* Excel columns for each row
+    """
+    out = dict(record)
+
+    for item in items:
+        prefix = f"generated_price_{int(item['line_no']):02d}"
+        out[f"{prefix}_quote_index"] = item["quote_index"]
+        out[f"{prefix}_name"] = item["name"]
+        out[f"{prefix}_cost"] = item["cost"]
+        out[f"{prefix}_validity"] = item["validity"]
+        out[f"{prefix}_validity_status"] = item["validity_status"]
+        out[f"{prefix}_include_in_total"] = "Yes" if item["include_in_total"] else "No"
+        out[f"{prefix}_is_grand_total"] = "Yes" if item["is_grand_total"] else "No"
+        out[f"{prefix}_is_display_only"] = "Yes" if item["is_display_only_red_row"] else "No"
+        for f in QUOTE_LINE_ITEM_NUM_FIELDS:
+            out[f"{prefix}_{f}"] = item[f]
+
+    out["generated_quote_prices_json"] = json.dumps(
+        items,
         ensure_ascii=False,
         default=str
     )
+    return out
 
-    return record
+# -------------------------
+# DROPDOWN VOCABULARY CACHE
+# -------------------------
+# list name -> (saved record field, base list)
+VOCABULARY_FIELDS: Dict[str, Tuple[str, List[str]]] = {
+    "commodities": ("commodity", BASE_COMMODITIES),
+    "salespersons": ("salesperson_name", SALESPERSONS),
+    "cargo_types": ("cargo_type", CARGO_TYPES),
+    "packaging_types": ("packaging_type", PACKAGING_TYPES),
+}
 
-def get_commodities():
-    commodities = list(BASE_COMMODITIES)
+_vocab_lock = threading.Lock()
+_vocab_load_lock = threading.Lock()
+_vocab_cache: Dict[str, Any] = {
+    "loaded_at": 0.0,
+    "lists": None,
+    # values saved by this worker; merged into every refresh, since with a
+    # journal queries.xlsx only gets them on the next export
+    "saved": {name: [] for name in VOCABULARY_FIELDS},
+}
+
+
+def _build_vocabulary_lists(remote: Dict[str, List[str]], saved: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Base list + workbook values + this worker's saves, deduplicated in that order."""
+    return {
+        name: list(dict.fromkeys(base + remote.get(name, []) + saved[name]))
+        for name, (_, base) in VOCABULARY_FIELDS.items()
+    }
+
+
+def remember_vocabulary_values(record: Dict[str, Any]):
+    """
+    Adds a just-saved quote's values to the dropdowns without re-reading
+    queries.xlsx (with a journal, the row only reaches it on the next export).
+    """
+    with _vocab_lock:
+        saved = _vocab_cache["saved"]
+        for name, (field, _) in VOCABULARY_FIELDS.items():
+            v = str(record.get(field) or "").strip()
+            if v and v not in saved[name]:
+                saved[name].append(v)
+        lists = _vocab_cache["lists"]
+        if lists is not None:
+            _vocab_cache["lists"] = _build_vocabulary_lists(lists, saved)
+
+
+def read_queries_vocabulary_values() -> Dict[str, List[str]]:
+    """
+    Distinct values of the vocabulary columns of queries.xlsx, in sheet
+    order. One download; only those columns are parsed and headers match
+    case-insensitively. A missing workbook has no values.
+    """
+    columns = {field: name for name, (field, _) in VOCABULARY_FIELDS.items()}
+    values: Dict[str, List[str]] = {name: [] for name in VOCABULARY_FIELDS}
     try:
-        df = read_queries_df_from_onedrive()
-        if not df.empty:
-            com_col = next((c for c in df.columns if c.lower() == "commodity"), None)
-            if com_col:
-                existing = df[com_col].dropna().astype(str).str.strip().unique()
-                for c in existing:
-                    if c and c not in commodities:
-                        commodities.append(c)
-    except Exception:
-        pass
-    return commodities
+        content = download_excel_from_onedrive(ONEDRIVE_QUERIES_PATH)
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return values
+        raise
+
+    df = pd.read_excel(
+        io.BytesIO(content),
+        sheet_name=0,
+        usecols=lambda c: str(c).strip().lower() in columns,
+    )
+    for col in df.columns:
+        name = columns[str(col).strip().lower()]
+        existing = df[col].dropna().astype(str).str.strip()
+        values[name].extend(v for v in existing.unique() if v)
+    return values
 
 
-def get_salespersons():
-    persons = list(SALESPERSONS)
+def get_vocabulary() -> Dict[str, List[str]]:
+    start_queries_exporter()  # with a journal: exports rows left from a previous run
+
+    with _vocab_lock:
+        lists = _vocab_cache["lists"]
+        if lists is not None and (time.time() - _vocab_cache["loaded_at"]) < VOCABULARY_TTL_SECONDS:
+            return lists
+
+    # one download per refresh; other threads keep the stale lists meanwhile
+    if not _vocab_load_lock.acquire(blocking=lists is None):
+        return lists
     try:
-        df = read_queries_df_from_onedrive()
-        if not df.empty:
-            col = next((c for c in df.columns if c.lower() == "salesperson_name"), None)
-            if col:
-                existing = df[col].dropna().astype(str).str.strip().unique()
-                for p in existing:
-                    if p and p not in persons:
-                        persons.append(p)
-    except Exception:
-        pass
-    return persons
+        with _vocab_lock:
+            if _vocab_cache["lists"] is not None and (time.time() - _vocab_cache["loaded_at"]) < VOCABULARY_TTL_SECONDS:
+                return _vocab_cache["lists"]  # refreshed while we waited
+        try:
+            remote: Optional[Dict[str, List[str]]] = read_queries_vocabulary_values()
+        except Exception as e:
+            print("Could not read dropdown values from queries.xlsx:", e)
+            remote = None
+
+        with _vocab_lock:
+            if remote is None and _vocab_cache["lists"] is not None:
+                # keep serving the last good lists, retry after the TTL
+                lists = _vocab_cache["lists"]
+            else:
+                lists = _build_vocabulary_lists(remote or {}, _vocab_cache["saved"])
+                _vocab_cache["lists"] = lists
+            _vocab_cache["loaded_at"] = time.time()
+        return lists
+    finally:
+        _vocab_load_lock.release()
+
+
+def get_commodities():
+    return list(get_vocabulary()["commodities"])
+
+
+def get_salespersons():
+    return list(get_vocabulary()["salespersons"])
 
 
 def get_cargo_types():
-    types = list(CARGO_TYPES)
-    try:
-        df = read_queries_df_from_onedrive()
-        if not df.empty:
-            col = next((c for c in df.columns if c.lower() == "cargo_type"), None)
-            if col:
-                existing = df[col].dropna().astype(str).str.strip().unique()
-                for t in existing:
-                    if t and t not in types:
-                        types.append(t)
-    except Exception:
-        pass
-    return types
+    return list(get_vocabulary()["cargo_types"])
 
 
 def get_packaging_types():
-    types = list(PACKAGING_TYPES)
-    try:
-        df = read_queries_df_from_onedrive()
-        if not df.empty:
-            col = next((c for c in df.columns if c.lower() == "packaging_type"), None)
-            if col:
-                existing = df[col].dropna().astype(str).str.strip().unique()
-                for t in existing:
-                    if t and t not in types:
-                        types.append(t)
-    except Exception:
-        pass
-    return types
+    return list(get_vocabulary()["packaging_types"])
 
 
 
@@ -1766,6 +4036,44 @@ def is_trucking_charge_column(col_name: str) -> bool:
     }
 
 
+@dataclass(frozen=True)
+class ChargeColumn:
+    """
+    How one price sheet header is treated by totals and quote rows.
+    """
+    key: str          # canon(header)
+    is_charge: bool   # is_charges_column()
+    is_trucking: bool
+    is_marker: bool   # section marker
+    is_blank: bool    # blank / Unnamed separator
+    bucket: str       # '20' | '40' | '2x20' | 'common'
+    base_name: str    # strip_size_suffix()
+
+
+@lru_cache(maxsize=64)
+def _charge_plan(columns: Tuple[Any, ...]) -> Dict[Any, ChargeColumn]:
+    return {
+        col: ChargeColumn(
+            key=canon(col),
+            is_charge=is_charges_column(col),
+            is_trucking=is_trucking_charge_column(col),
+            is_marker=is_section_marker_column(col),
+            is_blank=is_blank_or_unnamed_column(col),
+            bucket=charge_size_bucket(col),
+            base_name=strip_size_suffix(col),
+        )
+        for col in columns
+    }
+
+
+def get_charge_plan(columns: Any) -> Dict[Any, ChargeColumn]:
+    """
+    header -> ChargeColumn, classified once per header set (the sheet only
+    changes with the workbook version) and shared. Read-only.
+    """
+    return _charge_plan(tuple(columns))
+
+
 def get_selected_container_units(
     size_20ft_count: int,
     size_40ft_count: int,
@@ -1822,18 +4130,20 @@ def compute_selected_shipment_total_for_row(
     """
     total = 0.0
     found_any = False
+    plan = get_charge_plan(columns)
 
     for col in columns:
-        if not is_charges_column(col):
+        info = plan[col]
+        if not info.is_charge:
             continue
-        if is_trucking_charge_column(col):
+        if info.is_trucking:
             continue
 
         num = parse_price_to_float(row.get(col))
         if num is None:
             continue
 
-        bucket = charge_size_bucket(col)
+        bucket = info.bucket
 
         if bucket == "20":
             if total_20_units > 0:
@@ -1856,26 +4166,76 @@ def compute_selected_shipment_total_for_row(
     return float(total), bool(found_any)
 
 
+def parse_price_column(series: pd.Series) -> np.ndarray:
+    """
+    parse_price_to_float() over a whole column as float64, NaN where it
+    returns None. Numeric columns are converted without touching Python.
+    """
+    if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+    out = np.empty(len(series), dtype=np.float64)
+    for i, v in enumerate(series.array):
+        num = parse_price_to_float(v)
+        out[i] = np.nan if num is None else num
+    return out
+
+
 def compute_selected_shipment_totals_for_df(
     df: pd.DataFrame,
     columns: List[str],
     total_20_units: int,
     total_40_units: int
 ) -> Tuple[List[float], List[bool]]:
-    totals: List[float] = []
-    has_any: List[bool] = []
+    """
+    compute_selected_shipment_total_for_row() for every row at once.
+    Charge columns are classified once, parsed into a float64 matrix (NaN
+    for blanks) and weighted by bucket: 20ft / 40ft columns by the unit
+    counts, common columns by 1.
+    """
+    charge_cols: List[str] = []
+    weights: List[float] = []
+    plan = get_charge_plan(columns)
 
-    for _, row in df.iterrows():
-        t, ok = compute_selected_shipment_total_for_row(
-            row=row,
-            columns=columns,
-            total_20_units=total_20_units,
-            total_40_units=total_40_units
-        )
-        totals.append(float(t))
-        has_any.append(bool(ok))
+    for col in columns:
+        if col not in df.columns:
+            continue
+        info = plan[col]
+        if not info.is_charge:
+            continue
+        if info.is_trucking:
+            continue
 
-    return totals, has_any
+        bucket = info.bucket
+        if bucket == "20":
+            weight = float(total_20_units) if total_20_units > 0 else 0.0
+        elif bucket == "40":
+            weight = float(total_40_units) if total_40_units > 0 else 0.0
+        elif bucket == "2x20":
+            # no normal charge columns should use this pattern except trucking
+            continue
+        else:
+            weight = 1.0
+
+        if weight > 0:
+            charge_cols.append(col)
+            weights.append(weight)
+
+    totals = np.zeros(len(df), dtype=np.float64)
+    has_any = np.zeros(len(df), dtype=bool)
+    if not charge_cols:
+        return totals.tolist(), has_any.tolist()
+
+    matrix = np.column_stack([parse_price_column(df[col]) for col in charge_cols])
+    present = ~np.isnan(matrix)
+
+    # column by column (not a BLAS dot) so each row sums in the same order
+    # as the per-row loop and totals stay bit-identical
+    for j, weight in enumerate(weights):
+        totals += np.where(present[:, j], matrix[:, j] * weight, 0.0)
+    has_any = present.any(axis=1)
+
+    return totals.tolist(), has_any.tolist()
 def compute_trucking_plan_and_totals(
     matched_df: pd.DataFrame,
     single_20_count: int,
@@ -2098,51 +4458,35 @@ def get_strict_quotes(
     limit: int = 1
 ) -> Tuple[List[Dict[str, Any]], Optional[str], Optional[str]]:
     
-    df = load_prices_df()
+    snapshot = get_price_snapshot()
+    df = snapshot.df if snapshot is not None else None
     if df is None or df.empty:
         return [], None, "Could not load prices_updated.xlsx properly. Please confirm the file exists and headers are correct."
 
     # -------------------------
     # NEW: Keep only Basic + selected shipment mode section + routes
+    # (layout precomputed once per price-book version)
     # -------------------------
-    global_validity_col = get_validity_column_from_basic_section(df)
-
-    df, section_error_msg, selected_pricing_columns = select_pricing_columns_for_shipment_mode(
-        df=df,
-        shipment_mode=shipment_mode
-    )
+    layout, section_error_msg = shipment_mode_layout(snapshot.book, shipment_mode)
 
     if section_error_msg:
         return [], None, section_error_msg
 
-    if df is None or df.empty:
-        return [], None, "No pricing data found for the selected shipment mode."
-
-    if global_validity_col and global_validity_col not in df.columns:
-        global_validity_col = find_col_case_insensitive(df, "validity")
-
-    def col_exists(name: str) -> bool:
-        return name in df.columns
+    selected_pricing_columns = list(layout.columns)
+    global_validity_col = layout.validity_col
 
     POL_COL = "POL"
     POD_COL = "POD"
 
-    ORG_ADDR_COL = "wareshouse_address" if col_exists("wareshouse_address") else None
-    ORG_CITY_COL = "city" if col_exists("city") else None
-    ORG_COUNTRY_COL = "country" if col_exists("country") else None
-
-    DST_ADDR_COL = "wareshouse_address.1" if col_exists("wareshouse_address.1") else None
-    DST_CITY_COL = "city.1" if col_exists("city.1") else None
-    DST_COUNTRY_COL = "country.1" if col_exists("country.1") else None
+    ORG_ADDR_COL = layout.location_columns["origin_address"]
+    ORG_CITY_COL = layout.location_columns["origin_city"]
+    ORG_COUNTRY_COL = layout.location_columns["origin_country"]
 
-    if DST_ADDR_COL is None and col_exists("pod_wareshouse_address"):
-        DST_ADDR_COL = "pod_wareshouse_address"
-    if DST_CITY_COL is None and col_exists("pod_city"):
-        DST_CITY_COL = "pod_city"
-    if DST_COUNTRY_COL is None and col_exists("pod_country"):
-        DST_COUNTRY_COL = "pod_country"
+    DST_ADDR_COL = layout.location_columns["destination_address"]
+    DST_CITY_COL = layout.location_columns["destination_city"]
+    DST_COUNTRY_COL = layout.location_columns["destination_country"]
 
-    if POL_COL not in df.columns or POD_COL not in df.columns:
+    if POL_COL not in selected_pricing_columns or POD_COL not in selected_pricing_columns:
         return [], None, "Missing required columns in prices_updated.xlsx: POL and/or POD"
 
 
@@ -2186,24 +4530,23 @@ def get_strict_quotes(
         skip_destination_strict_filter = True
 
     pol_key = normalize_location_key(pol_port)
-    pod_key = normalize_location_key(pod_port)
-
-    df["_pol_key"] = df[POL_COL].apply(normalize_location_key)
-    df["_pod_key"] = df[POD_COL].apply(normalize_location_key)
-
-    pol_mask = df[POL_COL].apply(lambda x: flexible_location_match(pol_port, x))
-    pod_mask = df[POD_COL].apply(lambda x: flexible_location_match(pod_port, x))
+    lanes = snapshot.lanes
 
     # Base match used for shipping-line options:
     # user wants ALL shipping lines where only POL + POD match
+    # (row positions come from the lane index; only matching rows are copied)
     if selected_route_type_c in {"pol_to_city", "city_to_city", "city_to_country_to_city", "city_to_pol"}:
         # For inland routes, do not force POD matching
         if pol_key:
-            df_pol_pod = df[pol_mask].copy()
+            pol_pod_rows = price_lane_row_positions(lanes, pol_port, pod_port, require_pod=False)
         else:
-            df_pol_pod = df.copy()
+            pol_pod_rows = list(range(len(df)))
     else:
-        df_pol_pod = df[pol_mask & pod_mask].copy()
+        pol_pod_rows = price_lane_row_positions(lanes, pol_port, pod_port)
+
+    df_pol_pod = df.iloc[pol_pod_rows].loc[:, selected_pricing_columns]
+    df_pol_pod["_pol_key"] = [lanes.pol_keys[pos] for pos in pol_pod_rows]
+    df_pol_pod["_pod_key"] = [lanes.pod_keys[pos] for pos in pol_pod_rows]
 
     if df_pol_pod.empty:
         if selected_route_type_c in {"pol_to_city", "city_to_city", "city_to_country_to_city", "city_to_pol"}:
@@ -2227,7 +4570,7 @@ def get_strict_quotes(
         DST_CITY_COL,
         DST_COUNTRY_COL,
         find_col_case_insensitive(df_match, "Shipping Line Name"),
-        find_col_case_insensitive(df_match, "routes"),
+        layout.routes_col,
     ]
 
     for c in ffill_cols:
@@ -2238,7 +4581,7 @@ def get_strict_quotes(
     # ✅ NEW: Route filter using Excel column 'routes'
     # The selected UI route must also match the row's routes cell
     # -------------------------
-    routes_col = find_col_case_insensitive(df_match, "routes")
+    routes_col = layout.routes_col
 
     selected_route_id_clean = extract_route_id(selected_route_id)
     selected_route_text_clean = (selected_route_text or "").strip()
@@ -2459,6 +4802,8 @@ def get_strict_quotes(
     # ✅ BEST ROW selection (NEW size-aware logic)
     # -------------------------
     display_cols = [c for c in df_match.columns if not str(c).startswith("_")]
+    display_col_index = header_index(display_cols)
+    display_plan = get_charge_plan(display_cols)
 
     units_info = get_selected_container_units(
         size_20ft_count=size_20ft_count,
@@ -2519,7 +4864,7 @@ def get_strict_quotes(
     # Forward-fill grouped columns so sibling rows stay in the same quote group
     trucking_ffill_cols = [
         find_col_case_insensitive(trucking_src, "Shipping Line Name"),
-        find_col_case_insensitive(trucking_src, "routes"),
+        layout.routes_col,
         ORG_ADDR_COL,
         ORG_CITY_COL,
         ORG_COUNTRY_COL,
@@ -2650,7 +4995,7 @@ def get_strict_quotes(
         col_name: str,
         label: Optional[str] = None
     ):
-        actual = next((c for c in display_cols if canon(c) == canon(col_name)), None)
+        actual = display_col_index.get(canon(col_name))
         if not actual:
             return
 
@@ -2798,7 +5143,7 @@ def get_strict_quotes(
         col_name: str,
         label: Optional[str] = None
     ):
-        actual = next((c for c in display_cols if canon(c) == canon(col_name)), None)
+        actual = display_col_index.get(canon(col_name))
         if not actual:
             return
 
@@ -2832,11 +5177,11 @@ def get_strict_quotes(
         col_name: str,
         label: Optional[str] = None
     ):
-        actual = next((c for c in display_cols if canon(c) == canon(col_name)), None)
+        actual = display_col_index.get(canon(col_name))
         if not actual:
             return
 
-        bucket = charge_size_bucket(actual)
+        bucket = display_plan[actual].bucket
         raw_val = row.get(actual)
         num = parse_price_to_float(raw_val)
         if num is None:
@@ -2931,7 +5276,8 @@ def get_strict_quotes(
         while i < len(display_cols):
             col = display_cols[i]
             raw = row.get(col)
-            col_c = canon(col)
+            info = display_plan[col]
+            col_c = info.key
 
             if raw is None or pd.isna(raw) or str(raw).strip() == "":
                 i += 1
@@ -2942,19 +5288,19 @@ def get_strict_quotes(
                 continue
 
             # Do not show blank / Unnamed separator columns.
-            if is_blank_or_unnamed_column(col):
+            if info.is_blank:
                 i += 1
                 continue
 
             # Do not show section marker columns like Basic_Details_Section,
             # Ocean_Freight_Section, Airway_Section_Ends, etc.
-            if is_section_marker_column(col):
+            if info.is_marker:
                 i += 1
                 continue
 
             # Validity is now one Basic_Details_Section column applied to all rows,
             # so do not show it as a normal info row.
-            if "validity" in col_c and not is_charges_column(col):
+            if "validity" in col_c and not info.is_charge:
                 i += 1
                 continue
 
@@ -2962,12 +5308,12 @@ def get_strict_quotes(
                 i += 1
                 continue
 
-            bucket = charge_size_bucket(col)
+            bucket = info.bucket
 
             # -------------------------
             # NON-CHARGE COLUMNS
             # -------------------------
-            if not is_charges_column(col):
+            if not info.is_charge:
                 if bucket == "20" and total_20_units <= 0:
                     i += 1
                     continue
@@ -2977,11 +5323,11 @@ def get_strict_quotes(
                     continue
 
                 if bucket == "20":
-                    base_name = strip_size_suffix(col)
+                    base_name = info.base_name
                     next_col = display_cols[i + 1] if (i + 1) < len(display_cols) else None
-                    next_bucket = charge_size_bucket(next_col) if next_col else ""
+                    next_bucket = display_plan[next_col].bucket if next_col else ""
 
-                    if next_col and next_bucket == "40" and strip_size_suffix(next_col) == base_name:
+                    if next_col and next_bucket == "40" and display_plan[next_col].base_name == base_name:
                         if total_20_units > 0:
                             _append_info_row(table_rows, col, raw)
 
@@ -3001,14 +5347,14 @@ def get_strict_quotes(
             # CHARGE COLUMNS
             # -------------------------
             if bucket == "20":
-                base_name = strip_size_suffix(col)
+                base_name = info.base_name
                 next_col = display_cols[i + 1] if (i + 1) < len(display_cols) else None
-                next_bucket = charge_size_bucket(next_col) if next_col else ""
+                next_bucket = display_plan[next_col].bucket if next_col else ""
 
-                if next_col and next_bucket == "40" and strip_size_suffix(next_col) == base_name:
+                if next_col and next_bucket == "40" and display_plan[next_col].base_name == base_name:
                     validity_col_local = (
                         display_cols[i + 2]
-                        if (i + 2) < len(display_cols) and "validity" in canon(display_cols[i + 2])
+                        if (i + 2) < len(display_cols) and "validity" in display_plan[display_cols[i + 2]].key
                         else None
                     )
 
@@ -3489,37 +5835,130 @@ def build_routes_for_pol_pod(pol: str, pod: str):
     return routes, best_route_id, ""
 
 
-@app.post("/api/routes")
-def api_routes():
-    pol = (request.form.get("port_of_loading") or "").strip()
-    pod = (request.form.get("port_of_destination") or "").strip()
+# -------------------------
+# /api/routes RESPONSE CACHE
+# The form re-asks for the same lane on every edit; matching only looks at
+# normalized values, so the key is built from those.
+# -------------------------
+_routes_api_cache: "OrderedDict[Tuple[Any, ...], Tuple[float, bytes]]" = OrderedDict()
+_routes_api_cache_lock = threading.Lock()
+_routes_api_cache_stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
 
-    origin_city = (request.form.get("origin_city") or "").strip()
-    origin_country = (request.form.get("origin_country") or "").strip()
 
-    destination_city = (request.form.get("destination_city") or "").strip()
-    destination_country = (request.form.get("destination_country") or "").strip()
+def routes_api_cache_key(
+    pol: str,
+    pod: str,
+    origin_city: str,
+    origin_country: str,
+    destination_city: str,
+    destination_country: str,
+    transit_borders: List[str],
+    catalog_version: str,
+) -> Tuple[Any, ...]:
+    # borders only add a bonus if any of them matches -> order/duplicates don't matter
+    borders = tuple(sorted({_norm_kw_value(b) for b in transit_borders} - {""}))
+    return (
+        catalog_version,
+        _norm_kw_value(pol, is_port=True),
+        _norm_kw_value(pod, is_port=True),
+        _norm_kw_value(origin_city),
+        _norm_kw_value(origin_country),
+        _norm_kw_value(destination_city),
+        _norm_kw_value(destination_country),
+        borders,
+    )
 
-    transit_borders = [
-        (request.form.get("transit_border_1") or "").strip(),
-        (request.form.get("transit_border_2") or "").strip(),
-        (request.form.get("transit_border_3") or "").strip(),
-        (request.form.get("transit_border_4") or "").strip(),
-    ]
 
-    if not pol and not origin_city and not origin_country:
-        return jsonify({"ok": False, "routes": [], "best_route_id": None, "route_error_msg": ""}), 200
+def _routes_api_cache_get(key: Tuple[Any, ...]) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+    """(encoded body, parsed payload) for a cached lane, or None."""
+    with _routes_api_cache_lock:
+        entry = _routes_api_cache.get(key)
+        if entry is not None and time.time() - entry[0] < ROUTES_API_CACHE_TTL_SECONDS:
+            _routes_api_cache.move_to_end(key)
+            _routes_api_cache_stats["hits"] += 1
+            return entry[1], entry[2]
+        if entry is not None:
+            del _routes_api_cache[key]
+        _routes_api_cache_stats["misses"] += 1
+        return None
 
-    routes, best_route_id = get_matching_routes(
-        pol=pol,
-        pod=pod,
-        origin_city=origin_city,
-        origin_country=origin_country,
-        destination_city=destination_city,
-        destination_country=destination_country,
-        transit_borders=transit_borders
-    )
 
+def _routes_api_cache_put(key: Tuple[Any, ...], body: bytes, payload: Dict[str, Any]):
+    # payload is shared by every hit: treat it as read-only
+    if ROUTES_API_CACHE_SIZE <= 0:
+        return
+    with _routes_api_cache_lock:
+        _routes_api_cache[key] = (time.time(), body, payload)
+        _routes_api_cache.move_to_end(key)
+        while len(_routes_api_cache) > ROUTES_API_CACHE_SIZE:
+            _routes_api_cache.popitem(last=False)
+            _routes_api_cache_stats["evictions"] += 1
+
+
+def get_routes_api_cache_stats() -> Dict[str, Any]:
+    with _routes_api_cache_lock:
+        stats: Dict[str, Any] = dict(_routes_api_cache_stats)
+        stats["entries"] = len(_routes_api_cache)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    stats["max_entries"] = ROUTES_API_CACHE_SIZE
+    stats["ttl_seconds"] = ROUTES_API_CACHE_TTL_SECONDS
+    return stats
+
+
+def _json_body_response(body: bytes):
+    return app.response_class(body, status=200, mimetype="application/json")
+
+
+ROUTE_LANE_FIELDS = [
+    "port_of_loading",
+    "port_of_destination",
+    "origin_city",
+    "origin_country",
+    "destination_city",
+    "destination_country",
+]
+
+
+def route_lane_from_fields(src: Any) -> Dict[str, Any]:
+    """
+    One lane query from the route form fields (request.form or a JSON object).
+    Borders come as transit_border_1..4 or as a transit_borders list;
+    an optional "limit" keeps only the best N routes.
+    """
+    lane: Dict[str, Any] = {f: str(src.get(f) or "").strip() for f in ROUTE_LANE_FIELDS}
+    borders = src.get("transit_borders")
+    if not isinstance(borders, list):
+        borders = [src.get(f"transit_border_{i}") for i in range(1, 5)]
+    lane["transit_borders"] = [str(b or "").strip() for b in borders]
+
+    # optional top-k: only the best N routes are matched out and returned
+    try:
+        limit = int(src.get("limit") or 0)
+    except (TypeError, ValueError):
+        limit = 0
+    lane["limit"] = limit if limit > 0 else None
+    return lane
+
+
+def _route_lane_has_start(lane: Dict[str, Any]) -> bool:
+    return bool(lane["port_of_loading"] or lane["origin_city"] or lane["origin_country"])
+
+
+def _route_lane_cache_key(lane: Dict[str, Any], catalog: RouteCatalog) -> Tuple[Any, ...]:
+    return routes_api_cache_key(
+        lane["port_of_loading"],
+        lane["port_of_destination"],
+        lane["origin_city"],
+        lane["origin_country"],
+        lane["destination_city"],
+        lane["destination_country"],
+        lane["transit_borders"],
+        catalog.version,
+    ) + (lane["limit"],)
+
+
+def build_routes_payload(routes: List[Dict[str, Any]], best_route_id: Optional[str]) -> Dict[str, Any]:
     payload = []
     for r in routes:
         t = r.get("transit_time_days") if isinstance(r.get("transit_time_days"), dict) else {}
@@ -3538,11 +5977,204 @@ def api_routes():
             "transit_max": t.get("max") if isinstance(t, dict) else r.get("transit_max"),
         })
 
-    return jsonify({
+    return {
         "ok": True,
         "routes": payload,
         "best_route_id": str(best_route_id) if best_route_id is not None else None,
         "route_error_msg": ""
+    }
+
+
+def _rank_route_lane(
+    lane: Dict[str, Any],
+    catalog: RouteCatalog,
+    limit: Optional[int],
+    candidates: Optional[List[int]] = None
+) -> List[Tuple[RouteRecord, int]]:
+    return rank_route_records(
+        pol=lane["port_of_loading"],
+        pod=lane["port_of_destination"],
+        origin_city=lane["origin_city"],
+        origin_country=lane["origin_country"],
+        destination_city=lane["destination_city"],
+        destination_country=lane["destination_country"],
+        transit_borders=lane["transit_borders"],
+        catalog=catalog,
+        limit=limit,
+        candidates=candidates,
+    )
+
+
+def _route_lane_payload(ranked: List[Tuple[RouteRecord, int]]) -> Tuple[bytes, Dict[str, Any]]:
+    """(encoded body, payload) of a ranked lane."""
+    # serialize straight from the shared records, no per-route dict copies
+    best_route_id = ranked[0][0].route_id if ranked else None
+    payload = {
+        "ok": True,
+        "routes": [route_record_payload(record, record.route_id == best_route_id) for record, _score in ranked],
+        "best_route_id": str(best_route_id) if best_route_id is not None else None,
+        "route_error_msg": "",
+    }
+    return jsonify(payload).get_data(), payload
+
+
+def _route_lane_response(
+    lane: Dict[str, Any],
+    catalog: RouteCatalog,
+    cache_key: Tuple[Any, ...]
+) -> Tuple[bytes, Dict[str, Any]]:
+    """(encoded body, payload) of one lane, from the response cache when possible."""
+    cached = _routes_api_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    body, payload = _route_lane_payload(_rank_route_lane(lane, catalog, lane["limit"]))
+    _routes_api_cache_put(cache_key, body, payload)
+    return body, payload
+
+
+NO_ROUTE_LANE_PAYLOAD = {"ok": False, "routes": [], "best_route_id": None, "route_error_msg": ""}
+
+
+@app.post("/api/routes")
+def api_routes():
+    lane = route_lane_from_fields(request.form)
+    if not _route_lane_has_start(lane):
+        return jsonify(NO_ROUTE_LANE_PAYLOAD), 200
+
+    catalog = get_route_catalog()
+    body, _payload = _route_lane_response(lane, catalog, _route_lane_cache_key(lane, catalog))
+    return _json_body_response(body)
+
+
+@app.post("/api/routes/batch")
+def api_routes_batch():
+    """
+    Body: {"lanes": [{"port_of_loading": ..., "port_of_destination": ...,
+    "origin_city": ..., "transit_borders": [...]}, ...]}
+    Returns one /api/routes payload per lane, in request order. All lanes
+    are matched against the same catalog version; lanes that normalize to
+    the same query are ranked once (whatever their limit) and lanes to the
+    same places share one candidate lookup.
+    """
+    data = request.get_json(silent=True)
+    lanes = data.get("lanes") if isinstance(data, dict) else data
+    if not isinstance(lanes, list) or not lanes:
+        return jsonify({"ok": False, "results": [], "error": "Expected a JSON body with a non-empty 'lanes' list."}), 400
+    if len(lanes) > ROUTES_BATCH_MAX_LANES:
+        return jsonify({"ok": False, "results": [], "error": f"At most {ROUTES_BATCH_MAX_LANES} lanes per request."}), 400
+
+    catalog = get_route_catalog()
+    results: List[Optional[Dict[str, Any]]] = [None] * len(lanes)
+
+    # 1) normalize every lane once; answer cached and invalid lanes directly
+    pending: Dict[Tuple[Any, ...], Tuple[Dict[str, Any], List[int]]] = {}
+    for i, item in enumerate(lanes):
+        if not isinstance(item, dict):
+            results[i] = dict(NO_ROUTE_LANE_PAYLOAD, route_error_msg=f"Lane {i + 1} must be a JSON object.")
+            continue
+        lane = route_lane_from_fields(item)
+        if not _route_lane_has_start(lane):
+            results[i] = dict(NO_ROUTE_LANE_PAYLOAD)
+            continue
+
+        key = _route_lane_cache_key(lane, catalog)
+        if key in pending:
+            pending[key][1].append(i)
+            continue
+        cached = _routes_api_cache_get(key)
+        if cached is not None:
+            results[i] = cached[1]
+            continue
+        pending[key] = (lane, [i])
+
+    # 2) rank each distinct query once, at the widest limit asked for it
+    #    (a limited ranking is the head of the full one); lanes that only
+    #    differ in borders share the candidate pass
+    groups: Dict[Tuple[Any, ...], List[Tuple[Any, ...]]] = {}
+    for key in pending:
+        groups.setdefault(key[:-1], []).append(key)
+    candidates_by_place: Dict[Tuple[Any, ...], List[int]] = {}
+    for match_key, keys in groups.items():
+        lane = pending[keys[0]][0]
+        limits = [pending[key][0]["limit"] for key in keys]
+        widest = None if None in limits else max(limits)
+
+        place = match_key[1:7]
+        if place not in candidates_by_place:
+            candidates_by_place[place] = route_candidate_positions(
+                catalog,
+                pol=lane["port_of_loading"],
+                pod=lane["port_of_destination"],
+                origin_city=lane["origin_city"],
+                origin_country=lane["origin_country"],
+                destination_city=lane["destination_city"],
+                destination_country=lane["destination_country"],
+            )
+        ranked = _rank_route_lane(lane, catalog, widest, candidates=candidates_by_place[place])
+
+        for key in keys:
+            key_lane, positions = pending[key]
+            limit = key_lane["limit"]
+            # step 1 already missed the cache for this key: store directly
+            body, payload = _route_lane_payload(ranked if limit is None else ranked[:limit])
+            _routes_api_cache_put(key, body, payload)
+            for i in positions:
+                results[i] = payload
+
+    return jsonify({"ok": True, "results": results}), 200
+
+@app.post("/api/routes/compose")
+def api_routes_compose():
+    """
+    Same form fields as /api/routes. Start = origin city, else POL, else
+    origin country; end = destination city, else POD, else destination
+    country. Optional 'limit'.
+    """
+    lane = route_lane_from_fields(request.form)
+    origin = lane["origin_city"] or lane["port_of_loading"] or lane["origin_country"]
+    destination = lane["destination_city"] or lane["port_of_destination"] or lane["destination_country"]
+    if not origin or not destination:
+        return jsonify(NO_ROUTE_LANE_PAYLOAD), 200
+
+    try:
+        limit = int(request.form.get("limit") or ROUTE_COMPOSE_MAX_RESULTS)
+    except ValueError:
+        limit = ROUTE_COMPOSE_MAX_RESULTS
+    limit = max(1, min(limit, 4 * ROUTE_COMPOSE_MAX_RESULTS))
+
+    itineraries, best_id = compose_route_itineraries(origin, destination, limit=limit)
+    payload = build_routes_payload(itineraries, best_id)
+    for row, it in zip(payload["routes"], itineraries):
+        row["is_custom"] = True
+        row["legs"] = it["legs"]
+    return jsonify(payload), 200
+
+@app.get("/api/locations/suggest")
+def api_locations_suggest():
+    """
+    ?q=<typed text>&field=pol|pod|city|country|border&limit=N
+    """
+    q = (request.args.get("q") or "").strip()
+    field = canon(request.args.get("field"))
+    if field not in LOCATION_SUGGEST_KINDS:
+        field = ""
+    try:
+        limit = int(request.args.get("limit") or LOCATION_SUGGEST_LIMIT)
+    except ValueError:
+        limit = LOCATION_SUGGEST_LIMIT
+    limit = max(1, min(limit, 50))
+
+    return jsonify({"ok": True, "suggestions": suggest_locations(q, kind=field, limit=limit)}), 200
+
+@app.get("/api/cache/stats")
+def api_cache_stats():
+    return jsonify({
+        "ok": True,
+        "prices": get_prices_cache_stats(),
+        "quote_journal": get_quote_journal_stats(),
+        "routes": get_route_catalog_stats(),
+        "routes_api": get_routes_api_cache_stats(),
     }), 200
 
 @app.route("/submit", methods=["POST"])
@@ -4260,7 +6892,7 @@ def submit():
     # before saving to queries.xlsx.
     data = add_generated_quote_prices_to_record(data, rates)
 
-    save_ok, save_msg = save_to_excel(data)
+    save_ok, save_msg = save_to_excel(data, line_items=build_generated_quote_line_items(rates))
     if not save_ok:
         save_warning_msg = save_msg
 